@@ -2,11 +2,11 @@ from flask import Flask
 from dotenv import load_dotenv
 import os
 from werkzeug.middleware.proxy_fix import ProxyFix
-
-# Load environment variables
-load_dotenv()
+from app.structured_log import configure_logging
 
 def create_app():
+    # Load environment variables from .env; nothing happens at import time
+    load_dotenv()
     app = Flask(__name__)
     
     # Configure the app
@@ -18,29 +18,111 @@ def create_app():
     app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
     app.config['MAX_CONTENT_PATH'] = None  # No path length limit
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # Disable caching for uploaded files
+    app.config['LOG_FILE'] = os.environ.get('LOG_FILE', '/var/log/photoyarn/app.log')  # Empty logs to stderr
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
+    app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'json')  # 'json' or 'text'
+    app.config['LOG_SAMPLE_RATE'] = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))  # Fraction of per-image events kept
+    app.config['LOG_MAX_FIELD_LENGTH'] = int(os.environ.get('LOG_MAX_FIELD_LENGTH', 500))  # Longer strings (e.g. model responses) are truncated
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'  # Serve /metrics
+    app.config['TRACE_SAMPLE_RATE'] = float(os.environ.get('TRACE_SAMPLE_RATE', 0))  # Fraction of requests whose stage spans are logged
+    app.config['ANALYSIS_MAX_WORKERS'] = int(os.environ.get('ANALYSIS_MAX_WORKERS', 8))  # Concurrent Gemini vision calls per upload
+    app.config['BATCH_ANALYSIS_MAX_BYTES'] = int(os.environ.get('BATCH_ANALYSIS_MAX_BYTES', 0))  # Image bytes per multi-image request; 0 disables batching
+    app.config['JOB_MAX_WORKERS'] = int(os.environ.get('JOB_MAX_WORKERS', 16))  # Story jobs run in the background per process; their image work is capped below
+    app.config['ADMISSION_MAX_CONCURRENT_IMAGES'] = int(os.environ.get('ADMISSION_MAX_CONCURRENT_IMAGES', 16))  # Image preparations/requests in flight per process
+    app.config['ADMISSION_CLIENT_MAX_CONCURRENT_IMAGES'] = int(os.environ.get('ADMISSION_CLIENT_MAX_CONCURRENT_IMAGES', 16))  # ...and per client, further limited to a fair share when clients compete
+    app.config['ADMISSION_CLIENT_MAX_JOBS'] = int(os.environ.get('ADMISSION_CLIENT_MAX_JOBS', 2))  # Unfinished stories per client; 0 disables
+    app.config['ADMISSION_MAX_BACKLOG'] = int(os.environ.get('ADMISSION_MAX_BACKLOG', 2000))  # Unfinished job weight before new uploads get a 429; 0 disables
+    app.config['ADMISSION_BYTES_PER_UNIT'] = int(os.environ.get('ADMISSION_BYTES_PER_UNIT', 4 * 1024 * 1024))  # Job weight is images plus bytes in these units
+    app.config['ADMISSION_TICKET_TTL'] = int(os.environ.get('ADMISSION_TICKET_TTL', 4 * 60 * 60))  # Seconds before an unfinished job stops counting, e.g. after its worker died
+    app.config['ZIP_MAX_MEMBERS'] = int(os.environ.get('ZIP_MAX_MEMBERS', 2000))
+    app.config['ZIP_MAX_UNCOMPRESSED_SIZE'] = int(os.environ.get('ZIP_MAX_UNCOMPRESSED_SIZE', 1024 * 1024 * 1024))  # 1GB of extracted images
+    app.config['ZIP_MAX_MEMBER_SIZE'] = int(os.environ.get('ZIP_MAX_MEMBER_SIZE', 100 * 1024 * 1024))  # 100MB per image
+    app.config['UPLOAD_MAX_SIZE'] = int(os.environ.get('UPLOAD_MAX_SIZE', 500 * 1024 * 1024))  # Per file sent through resumable uploads
+    app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))  # Largest accepted chunk
+    app.config['UPLOAD_SESSION_FOLDER'] = os.environ.get('UPLOAD_SESSION_FOLDER')  # Defaults to the instance folder
+    app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 60 * 60))  # Seconds an idle upload is kept
+    app.config['UPLOAD_WARMUP'] = os.environ.get('UPLOAD_WARMUP', '1') != '0'  # Analyze zip members while the upload is still arriving
+    app.config['UPLOAD_WARMUP_WORKERS'] = int(os.environ.get('UPLOAD_WARMUP_WORKERS', 2))
+    app.config['UPLOAD_WARMUP_MAX_MEMBERS'] = int(os.environ.get('UPLOAD_WARMUP_MAX_MEMBERS', 200))  # Members analyzed ahead of completion per upload
+    app.config['DISPLAY_MAX_SIZE'] = int(os.environ.get('DISPLAY_MAX_SIZE', 1600))  # Longest side of slideshow images
+    app.config['DISPLAY_JPEG_QUALITY'] = int(os.environ.get('DISPLAY_JPEG_QUALITY', 82))
+    app.config['PREPROCESS_BACKEND'] = os.environ.get('PREPROCESS_BACKEND', 'thread')  # 'thread' or 'process'
+    app.config['PREPROCESS_WORKERS'] = int(os.environ.get('PREPROCESS_WORKERS', 0)) or None  # Defaults to available cores
+    app.config['DEDUP_HAMMING_THRESHOLD'] = int(os.environ.get('DEDUP_HAMMING_THRESHOLD', 5))  # Max dHash bit difference for near-duplicates; -1 disables
+    app.config['STORY_MAP_REDUCE_THRESHOLD'] = int(os.environ.get('STORY_MAP_REDUCE_THRESHOLD', 60))  # Image count above which stories are written map-reduce; 0 disables
+    app.config['STORY_CHUNK_SIZE'] = int(os.environ.get('STORY_CHUNK_SIZE', 25))  # Image summaries per digest chunk
+    app.config['STREAM_STORY'] = os.environ.get('STREAM_STORY', '1') != '0'  # Push slides to clients as story beats arrive
+    app.config['GEMINI_API_KEY'] = os.environ.get('GEMINI_API_KEY')  # Used when a request brings no key of its own
+    app.config['GEMINI_BACKEND'] = os.environ.get('GEMINI_BACKEND', 'gemini')  # Or 'module:factory', e.g. bench.fake_gemini:FakeGenerativeModel
+    app.config['GEMINI_CLIENT_POOL_SIZE'] = int(os.environ.get('GEMINI_CLIENT_POOL_SIZE', 32))  # API keys with a warm client
+    app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') != '0'  # Read by Flask-Limiter; benchmarks turn it off
+    app.config['REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+    app.config['RATELIMIT_STORAGE_URI'] = app.config['REDIS_URL']
+    app.config['GEMINI_RATE_LIMIT'] = float(os.environ.get('GEMINI_RATE_LIMIT', 5))  # Requests per second per API key
+    app.config['GEMINI_RATE_BURST'] = int(os.environ.get('GEMINI_RATE_BURST', 10))
+    app.config['GEMINI_MAX_QUEUE_WAIT'] = float(os.environ.get('GEMINI_MAX_QUEUE_WAIT', 60))  # Seconds a call may wait for a token
+    app.config['GEMINI_MAX_RETRIES'] = int(os.environ.get('GEMINI_MAX_RETRIES', 4))
+    app.config['GEMINI_BACKOFF_BASE'] = float(os.environ.get('GEMINI_BACKOFF_BASE', 1.0))  # Seconds
+    app.config['GEMINI_BACKOFF_MAX'] = float(os.environ.get('GEMINI_BACKOFF_MAX', 30.0))
+    app.config['GEMINI_CIRCUIT_THRESHOLD'] = int(os.environ.get('GEMINI_CIRCUIT_THRESHOLD', 5))  # Consecutive upstream failures
+    app.config['GEMINI_CIRCUIT_COOLDOWN'] = int(os.environ.get('GEMINI_CIRCUIT_COOLDOWN', 30))  # Seconds to fail fast
+    app.config['ANALYSIS_CACHE_ENABLED'] = os.environ.get('ANALYSIS_CACHE_ENABLED', '1') != '0'
+    app.config['ANALYSIS_CACHE_PATH'] = os.environ.get('ANALYSIS_CACHE_PATH')  # Defaults to the instance folder
+    app.config['ANALYSIS_CACHE_TTL'] = int(os.environ.get('ANALYSIS_CACHE_TTL', 7 * 24 * 60 * 60))  # Seconds
+    app.config['ANALYSIS_CACHE_MAX_ENTRIES'] = int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', 50000))
+    app.config['STORY_TTL'] = int(os.environ.get('STORY_TTL', 4 * 60 * 60))  # Seconds a story is kept
+    app.config['STORY_INDEX_PATH'] = os.environ.get('STORY_INDEX_PATH')  # Defaults to the instance folder
+    app.config['STORY_SWEEP_INTERVAL'] = int(os.environ.get('STORY_SWEEP_INTERVAL', 60))  # Seconds between expiry sweeps
+    app.config['STORY_SWEEP_BATCH_SIZE'] = int(os.environ.get('STORY_SWEEP_BATCH_SIZE', 100))  # Stories deleted per batch
+    app.config['STORY_DISK_HIGH_WATER'] = float(os.environ.get('STORY_DISK_HIGH_WATER', 0.90))  # Disk usage fraction that triggers eviction
+    app.config['STORY_DISK_LOW_WATER'] = float(os.environ.get('STORY_DISK_LOW_WATER', 0.80))  # Evict oldest stories until usage drops below this
+    app.config['STORY_MAX_TOTAL_BYTES'] = int(os.environ.get('STORY_MAX_TOTAL_BYTES', 0))  # Cap on indexed story bytes; 0 disables
+    app.config['ACCEL_REDIRECT_PREFIX'] = os.environ.get('ACCEL_REDIRECT_PREFIX')  # nginx internal location aliasing app/static, e.g. /_static
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'  # Let Apache/lighttpd send static files
+    app.config['STORY_CACHE_MAX_ENTRIES'] = int(os.environ.get('STORY_CACHE_MAX_ENTRIES', 256))  # Parsed stories kept per process
     
+    # Threads and executors started from here are restarted in workers forked from a preloaded app
+    configure_logging(app)
+
     # Increase buffer size for large file uploads
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+    # Behind one proxy (nginx); x_for gives each user their own address for rate limits and admission
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
     
     # Ensure upload directory exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-    # Clean up temp_images directory on startup
     temp_images_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'temp_images')
-    if os.path.exists(temp_images_dir):
-        for filename in os.listdir(temp_images_dir):
-            file_path = os.path.join(temp_images_dir, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            except Exception as e:
-                print(f"Warning: Could not remove {file_path}: {e}")
-    else:
-        os.makedirs(temp_images_dir, exist_ok=True)
+    os.makedirs(temp_images_dir, exist_ok=True)
     
     # Register blueprints
     from app.routes import main, limiter
+    from app.jobs import job_tracker
+    from app.analysis_cache import analysis_cache
+    from app.imaging import image_preprocessor
+    from app.gemini import model_pool
+    from app.call_scheduler import call_scheduler
+    from app.story_index import story_index, story_sweeper
+    from app.story_store import story_store
+    from app.assets import static_assets
+    from app.uploads import chunked_uploads
+    from app.metrics import metrics
+    from app.admission import admission
     limiter.init_app(app)
+    metrics.init_app(app)
+    job_tracker.init_app(app)
+    admission.init_app(app)
+    analysis_cache.init_app(app)
+    image_preprocessor.init_app(app)
+    model_pool.init_app(app)
+    call_scheduler.init_app(app)
+    story_index.init_app(app)
+    story_sweeper.init_app(app)
+    # Leftover temp_images are cleared by the sweeper thread, once per host, without delaying startup
+    story_sweeper.add_scratch_dir(temp_images_dir)
+    story_sweeper.start()
+    story_store.init_app(app)
+    static_assets.init_app(app)
+    chunked_uploads.init_app(app)
     app.register_blueprint(main)
     
     return app 
\ No newline at end of file
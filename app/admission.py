@@ -0,0 +1,347 @@
+import math
+import time
+import uuid
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import redis
+from app.metrics import metrics
+from app.shared_state import SharedState, KEY_PREFIX
+
+class AdmissionRejected(Exception):
+    """Raised when a story job is not accepted now; ``retry_after`` is a hint in seconds"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Admit a job if its client and the host-wide backlog have room. Tickets are
+# stored as "weight client" with a deadline, so jobs of a worker that died
+# without finishing stop counting once their deadline passes. Returns the
+# outcome and the excess weight used for the retry hint; ARGV[7] is 1 to
+# reserve the ticket, 0 to only check.
+ADMIT_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+for _, stale in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('HDEL', KEYS[1], stale)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local client = ARGV[2]
+local weight = tonumber(ARGV[3])
+local client_max_jobs = tonumber(ARGV[4])
+local max_backlog = tonumber(ARGV[5])
+local backlog = 0
+local client_jobs = 0
+for _, value in ipairs(redis.call('HVALS', KEYS[1])) do
+    local sep = string.find(value, ' ', 1, true)
+    backlog = backlog + tonumber(string.sub(value, 1, sep - 1))
+    if string.sub(value, sep + 1) == client then
+        client_jobs = client_jobs + 1
+    end
+end
+if client_max_jobs > 0 and client_jobs >= client_max_jobs then
+    return {'client_limit', tostring(weight)}
+end
+if max_backlog > 0 and backlog > 0 and backlog + weight > max_backlog then
+    return {'backlog', tostring(backlog + weight - max_backlog)}
+end
+if ARGV[7] == '1' then
+    redis.call('HSET', KEYS[1], ARGV[1], weight .. ' ' .. client)
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[6]), ARGV[1])
+end
+return {'admitted', '0'}
+"""
+
+# Release a ticket and record its weight as completed for the throughput estimate
+FINISH_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+if value then
+    local weight = string.sub(value, 1, string.find(value, ' ', 1, true) - 1)
+    redis.call('ZADD', KEYS[3], now, ARGV[1] .. ':' .. weight)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - tonumber(ARGV[2]))
+redis.call('EXPIRE', KEYS[3], math.ceil(tonumber(ARGV[2])))
+return 1
+"""
+
+# Weight completed per second over the window; an empty string before any job finishes
+THROUGHPUT_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local completed = redis.call('ZRANGEBYSCORE', KEYS[1], now - tonumber(ARGV[1]), '+inf', 'WITHSCORES')
+if #completed == 0 then
+    return ''
+end
+local total = 0
+for i = 1, #completed, 2 do
+    local member = completed[i]
+    total = total + tonumber(string.sub(member, string.find(member, ':', 1, true) + 1))
+end
+return tostring(total / math.max(1, now - tonumber(completed[2])))
+"""
+
+def _decide(backlog, client_jobs, weight, client_max_jobs, max_backlog):
+    """(outcome, excess weight) for a job, by the same rules as ADMIT_SCRIPT"""
+    if client_max_jobs and client_jobs >= client_max_jobs:
+        return 'client_limit', weight
+    if max_backlog and backlog and backlog + weight > max_backlog:
+        return 'backlog', backlog + weight - max_backlog
+    return 'admitted', 0
+
+class LocalBacklog:
+    """In-process admitted jobs, used when Redis is not configured or unreachable"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tickets = {}  # ticket id -> (client, weight)
+        self.completed = deque()  # (finished_at, weight)
+
+    def admit(self, ticket_id, client, weight, client_max_jobs, max_backlog, ttl, reserve):
+        with self.lock:
+            backlog = sum(job_weight for _, job_weight in self.tickets.values())
+            client_jobs = sum(1 for job_client, _ in self.tickets.values() if job_client == client)
+            outcome, excess = _decide(backlog, client_jobs, weight, client_max_jobs, max_backlog)
+            if outcome == 'admitted' and reserve:
+                self.tickets[ticket_id] = (client, weight)
+            return outcome, excess
+
+    def finish(self, ticket_id, window):
+        with self.lock:
+            ticket = self.tickets.pop(ticket_id, None)
+            now = time.time()
+            if ticket is not None:
+                self.completed.append((now, ticket[1]))
+            while self.completed and self.completed[0][0] < now - window:
+                self.completed.popleft()
+
+    def throughput(self, window):
+        with self.lock:
+            now = time.time()
+            while self.completed and self.completed[0][0] < now - window:
+                self.completed.popleft()
+            if not self.completed:
+                return None
+            return sum(weight for _, weight in self.completed) / max(1.0, now - self.completed[0][0])
+
+    def backlog(self):
+        with self.lock:
+            return sum(weight for _, weight in self.tickets.values())
+
+class RedisBacklog:
+    """Admitted jobs shared by every worker through Redis"""
+    PREFIX = KEY_PREFIX + 'admission:'
+
+    def __init__(self, client):
+        self.client = client
+        self.admit_script = client.register_script(ADMIT_SCRIPT)
+        self.finish_script = client.register_script(FINISH_SCRIPT)
+        self.throughput_script = client.register_script(THROUGHPUT_SCRIPT)
+
+    def admit(self, ticket_id, client, weight, client_max_jobs, max_backlog, ttl, reserve):
+        outcome, excess = self.admit_script(
+            keys=[self.PREFIX + 'tickets', self.PREFIX + 'deadlines'],
+            args=[ticket_id, client, weight, client_max_jobs, max_backlog, ttl, 1 if reserve else 0]
+        )
+        return outcome.decode(), float(excess)
+
+    def finish(self, ticket_id, window):
+        self.finish_script(keys=[self.PREFIX + 'tickets', self.PREFIX + 'deadlines', self.PREFIX + 'completed'],
+                           args=[ticket_id, window])
+
+    def throughput(self, window):
+        rate = self.throughput_script(keys=[self.PREFIX + 'completed'], args=[window])
+        return float(rate) if rate else None
+
+    def backlog(self):
+        return sum(int(value.split(b' ', 1)[0]) for value in self.client.hvals(self.PREFIX + 'tickets'))
+
+class AdmissionController:
+    """Admission control and fair image scheduling for story jobs.
+
+    A job is weighed by its image count plus its bytes in units of
+    ``bytes_per_unit``. Jobs are admitted while the client has fewer than
+    ``client_max_jobs`` unfinished jobs and the total unfinished weight stays
+    under ``max_backlog``; otherwise they are rejected before any work, with a
+    retry hint from the recent completion rate. An idle server always admits
+    one job, however large.
+
+    Inside admitted jobs each unit of image work (preparing an image,
+    analyzing it, or one batch request) holds a slot. At most
+    ``max_concurrent`` slots are held in total. A client may hold up to
+    ``client_max_concurrent`` slots, but never more than an equal share of
+    ``max_concurrent`` among the clients that currently hold or want slots.
+    A client alone gets the whole pool. When a slot frees up it goes to the
+    next waiting client, in round-robin order, that is still under its share.
+    A small story therefore waits for one image of a large story, not for the
+    whole story.
+
+    Admitted jobs live in Redis so the backlog and per-client limits hold
+    across all gunicorn workers; if Redis is unavailable admission degrades
+    to per-process state (see ``SharedState``). Slots are per process: they
+    bound this process's threads, while the Gemini budget they feed is shared
+    by the call scheduler.
+    """
+    RATE_WINDOW = 300  # Seconds of completed jobs used to estimate throughput
+    DEFAULT_RETRY_AFTER = 30
+    MAX_RETRY_AFTER = 3600
+
+    def __init__(self):
+        self.max_concurrent = 16
+        self.client_max_concurrent = 16
+        self.client_max_jobs = 2
+        self.max_backlog = 2000
+        self.bytes_per_unit = 4 * 1024 * 1024
+        self.ticket_ttl = 4 * 60 * 60
+        self.store = SharedState(LocalBacklog(), 'story admission')
+        self.lock = threading.Lock()
+        self.running = 0
+        self.client_running = {}  # client -> slots held
+        self.waiting = OrderedDict()  # client -> deque of Events, in round-robin order
+
+    def init_app(self, app):
+        self.max_concurrent = app.config.get('ADMISSION_MAX_CONCURRENT_IMAGES', self.max_concurrent)
+        self.client_max_concurrent = app.config.get('ADMISSION_CLIENT_MAX_CONCURRENT_IMAGES', self.client_max_concurrent)
+        self.client_max_jobs = app.config.get('ADMISSION_CLIENT_MAX_JOBS', self.client_max_jobs)
+        self.max_backlog = app.config.get('ADMISSION_MAX_BACKLOG', self.max_backlog)
+        self.bytes_per_unit = app.config.get('ADMISSION_BYTES_PER_UNIT', self.bytes_per_unit)
+        self.ticket_ttl = app.config.get('ADMISSION_TICKET_TTL', self.ticket_ttl)
+        self.store.init_app(app, RedisBacklog)
+
+    def weight(self, images=0, size=0):
+        return max(1, images + math.ceil(size / self.bytes_per_unit))
+
+    def _retry_after(self, excess):
+        rate = self.store.run('throughput', self.RATE_WINDOW)
+        if not rate:
+            return self.DEFAULT_RETRY_AFTER
+        return int(min(self.MAX_RETRY_AFTER, max(1, math.ceil(excess / rate))))
+
+    def _admit(self, client, weight, reserve):
+        """Reserve a ticket for the job, or raise AdmissionRejected; returns the ticket id and where it is kept"""
+        ticket_id = uuid.uuid4().hex
+        args = (ticket_id, client, weight, self.client_max_jobs, self.max_backlog, self.ticket_ttl, reserve)
+        shared = self.store.available()
+        if shared is not None:
+            try:
+                outcome, excess = shared.admit(*args)
+            except redis.RedisError as e:
+                self.store.failed(e)
+                shared = None
+            else:
+                self.store.ok()
+        if shared is None:
+            outcome, excess = self.store.local.admit(*args)
+        if outcome == 'client_limit':
+            ADMISSION_DECISIONS.inc(outcome='client_limit')
+            raise AdmissionRejected("Too many of your stories are being written; "
+                                    "try again when one finishes", self._retry_after(excess))
+        if outcome == 'backlog':
+            ADMISSION_DECISIONS.inc(outcome='backlog')
+            raise AdmissionRejected('The server is busy; please try again later', self._retry_after(excess))
+        return ticket_id, shared is not None
+
+    def check(self, client, images=0, size=0):
+        """Reject early, e.g. from the request size alone, without admitting anything"""
+        self._admit(client, self.weight(images, size), reserve=False)
+
+    def admit(self, client, images=0, size=0):
+        """Admit a job and return its ticket for finish(); raises AdmissionRejected"""
+        ticket_id, shared = self._admit(client, self.weight(images, size), reserve=True)
+        ADMISSION_DECISIONS.inc(outcome='admitted')
+        return {'id': ticket_id, 'shared': shared}
+
+    def finish(self, ticket):
+        if not ticket['shared']:
+            return self.store.local.finish(ticket['id'], self.RATE_WINDOW)
+        # While Redis is down a shared ticket is left to expire after ticket_ttl
+        shared = self.store.available()
+        if shared is None:
+            return
+        try:
+            shared.finish(ticket['id'], self.RATE_WINDOW)
+        except redis.RedisError as e:
+            self.store.failed(e)
+
+    def bind(self, ticket, fn):
+        """Wrap a job function so its ticket is finished however the job ends"""
+        def run(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.finish(ticket)
+        return run
+
+    def _client_limit(self, client):
+        """Slots client may hold: its fair share of max_concurrent among busy clients, up to client_max_concurrent"""
+        busy = set(self.client_running) | set(self.waiting)
+        busy.add(client)
+        return min(self.client_max_concurrent, max(1, math.ceil(self.max_concurrent / len(busy))))
+
+    def _has_room(self, client):
+        return self.running < self.max_concurrent and self.client_running.get(client, 0) < self._client_limit(client)
+
+    def _take(self, client):
+        self.running += 1
+        self.client_running[client] = self.client_running.get(client, 0) + 1
+
+    def _dispatch(self):
+        """Hand free slots to waiting clients in turn; caller must hold self.lock"""
+        while self.running < self.max_concurrent:
+            for client, waiters in self.waiting.items():
+                if self.client_running.get(client, 0) < self._client_limit(client):
+                    break
+            else:
+                return
+            waiter = waiters.popleft()
+            if waiters:
+                self.waiting.move_to_end(client)
+            else:
+                del self.waiting[client]
+            self._take(client)
+            waiter.set()
+
+    @contextmanager
+    def slot(self, client):
+        """Hold one unit of image work for client, waiting for its round-robin turn"""
+        start_time = time.perf_counter()
+        with self.lock:
+            if self._has_room(client):
+                self._take(client)
+                waiter = None
+            else:
+                waiter = threading.Event()
+                self.waiting.setdefault(client, deque()).append(waiter)
+        if waiter is not None:
+            waiter.wait()
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start_time)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.running -= 1
+                remaining = self.client_running[client] - 1
+                if remaining:
+                    self.client_running[client] = remaining
+                else:
+                    del self.client_running[client]
+                self._dispatch()
+
+    def state(self):
+        """Backlog weight and this process's slots in use or waited for, for the admission gauge"""
+        backlog = self.store.run('backlog')
+        with self.lock:
+            return {
+                ('backlog',): backlog,
+                ('running',): self.running,
+                ('waiting',): sum(len(waiters) for waiters in self.waiting.values())
+            }
+
+admission = AdmissionController()
+
+ADMISSION_DECISIONS = metrics.counter('photoyarn_admission_decisions_total', 'Story job admission decisions', ['outcome'])
+ADMISSION_WAIT_SECONDS = metrics.histogram('photoyarn_admission_wait_seconds', 'Time image work waited for a scheduler slot')
+metrics.gauge('photoyarn_admission', 'Unfinished admitted job weight, and image slots running or waiting',
+              ['state'], callback=admission.state)
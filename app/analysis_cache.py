@@ -0,0 +1,127 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+class AnalysisCache:
+    """Persistent cache of Gemini image analyses keyed by preprocessed image content.
+
+    Keys hash the normalized JPEG bytes sent to the API together with the model
+    name and prompt, so re-uploading the same photos reuses earlier summaries
+    while a prompt or model change naturally misses. Entries are evicted by TTL
+    and, past ``max_entries``, least recently used first. The SQLite file is
+    shared by every worker process on the host, and so are the hit/miss counters.
+    """
+    PURGE_INTERVAL = 300  # Seconds between expired-entry sweeps per process
+
+    def __init__(self):
+        self.path = None
+        self.ttl = 7 * 24 * 60 * 60
+        self.max_entries = 50000
+        self.last_purge = 0
+
+    def init_app(self, app):
+        if not app.config.get('ANALYSIS_CACHE_ENABLED', True):
+            self.path = None
+            return
+        self.path = app.config.get('ANALYSIS_CACHE_PATH') or os.path.join(app.instance_path, 'analysis_cache.sqlite3')
+        self.ttl = app.config.get('ANALYSIS_CACHE_TTL', self.ttl)
+        self.max_entries = app.config.get('ANALYSIS_CACHE_MAX_ENTRIES', self.max_entries)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS analyses (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS analyses_last_access ON analyses (last_access)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+        logger.info(f"Analysis cache enabled at {self.path}")
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def make_key(image_bytes, model_name, prompt):
+        digest = hashlib.sha256()
+        digest.update(image_bytes)
+        digest.update(b'\0' + model_name.encode() + b'\0' + prompt.encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached summary for key, or None on a miss"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT summary FROM analyses WHERE key = ? AND created_at > ?',
+                    (key, now - self.ttl)
+                ).fetchone()
+                if row:
+                    conn.execute('UPDATE analyses SET last_access = ? WHERE key = ?', (now, key))
+                conn.execute('UPDATE counters SET value = value + 1 WHERE name = ?', ('hits' if row else 'misses',))
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Analysis cache lookup failed: {str(e)}")
+            return None
+
+    def put(self, key, summary):
+        if not self.enabled:
+            return
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO analyses (key, summary, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)',
+                    (key, summary, len(summary.encode()), now, now)
+                )
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.error(f"Analysis cache write failed: {str(e)}")
+
+    def _evict(self, conn, now):
+        evicted = 0
+        if now - self.last_purge >= self.PURGE_INTERVAL:
+            self.last_purge = now
+            evicted += conn.execute('DELETE FROM analyses WHERE created_at <= ?', (now - self.ttl,)).rowcount
+        count = conn.execute('SELECT COUNT(*) FROM analyses').fetchone()[0]
+        if count > self.max_entries:
+            evicted += conn.execute(
+                'DELETE FROM analyses WHERE key IN (SELECT key FROM analyses ORDER BY last_access LIMIT ?)',
+                (count - self.max_entries,)
+            ).rowcount
+        if evicted:
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'evictions'", (evicted,))
+            logger.info(f"Evicted {evicted} entries from the analysis cache")
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        with self._connect() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+            entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses').fetchone()
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        return {
+            'enabled': True,
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'evictions': counters.get('evictions', 0),
+            'hit_rate': counters.get('hits', 0) / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size
+        }
+
+analysis_cache = AnalysisCache()
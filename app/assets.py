@@ -0,0 +1,143 @@
+import os
+import re
+import gzip
+import hashlib
+import logging
+import threading
+from flask import Response, request, send_from_directory, abort
+from werkzeug.security import safe_join
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+PRECOMPRESS_EXTENSIONS = ('.css', '.js')
+FINGERPRINTED_IMAGE = re.compile(r'\.[0-9a-f]{12}\.jpe?g$')
+MIMETYPES = {'.css': 'text/css', '.js': 'text/javascript', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg'}
+
+def file_digest(path, length=12):
+    """Short SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()[:length]
+
+def fingerprint_file(path):
+    """Rename ``name.display.jpg`` to ``name.<digest>.jpg`` and return the new basename.
+
+    Story images never change once written, so a content hash in the name
+    lets them be cached forever.
+    """
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    if stem.endswith('.display'):
+        stem = stem[:-len('.display')]
+    fingerprinted = f"{stem}.{file_digest(path)}{ext}"
+    os.replace(path, os.path.join(directory, fingerprinted))
+    return fingerprinted
+
+def precompress(path):
+    """Write path.gz next to path unless an up-to-date one exists"""
+    gz_path = path + '.gz'
+    if os.path.exists(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(path):
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    tmp_path = gz_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    os.replace(tmp_path, gz_path)
+
+class StaticAssets:
+    """Serves CSS/JS and story images with long-lived, immutable caching.
+
+    CSS and JS are linked through ``asset_url()``, which puts the file's
+    content digest in the URL, and get a gzip sibling at startup that is
+    served to clients that accept it (and that nginx can serve with
+    ``gzip_static``). Story images carry their digest in the filename. With
+    ``ACCEL_REDIRECT_PREFIX`` set, responses hand the file to nginx through
+    ``X-Accel-Redirect`` (an internal location aliasing the static folder)
+    instead of streaming it from Python; Flask's ``USE_X_SENDFILE`` does the
+    same for Apache or lighttpd.
+
+    ``version`` digests every CSS/JS file and template as of startup, so
+    validators of rendered pages change when a deploy changes how they look.
+    """
+    def __init__(self):
+        self.static_folder = None
+        self.accel_prefix = None
+        self.digests = {}  # filename -> (mtime, digest)
+        self.version = ''
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.accel_prefix = (app.config.get('ACCEL_REDIRECT_PREFIX') or '').rstrip('/') or None
+        version = hashlib.sha256()
+        for directory in ('css', 'js'):
+            for root, _, files in os.walk(os.path.join(self.static_folder, directory)):
+                for name in sorted(files):
+                    if name.endswith(PRECOMPRESS_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        version.update(f"{os.path.relpath(path, self.static_folder)}:{file_digest(path)}\n".encode())
+                        try:
+                            precompress(path)
+                        except OSError as e:
+                            logger.warning(f"Could not precompress {name}: {str(e)}")
+        for root, _, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                version.update(f"{os.path.relpath(path, app.root_path)}:{file_digest(path)}\n".encode())
+        self.version = version.hexdigest()[:12]
+        app.add_template_global(self.url, 'asset_url')
+
+    def digest(self, filename):
+        path = os.path.join(self.static_folder, filename)
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            cached = self.digests.get(filename)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        digest = file_digest(path)
+        with self.lock:
+            self.digests[filename] = (mtime, digest)
+        return digest
+
+    def url(self, filename):
+        """Fingerprinted URL for a CSS/JS file under the static folder"""
+        return f"/assets/{self.digest(filename)}/{filename}"
+
+    def send(self, directory, filename, immutable=True):
+        """Serve directory/filename (relative to the static folder) with cache headers"""
+        path = safe_join(self.static_folder, directory, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        relative_path = f"{directory}/{filename}"
+        ext = os.path.splitext(filename)[1].lower()
+        gzipped = (ext in PRECOMPRESS_EXTENSIONS
+                   and 'gzip' in request.headers.get('Accept-Encoding', '')
+                   and os.path.exists(path + '.gz'))
+
+        if self.accel_prefix:
+            # nginx applies gzip_static itself in the internal location
+            response = Response(mimetype=MIMETYPES.get(ext, 'application/octet-stream'))
+            response.headers['X-Accel-Redirect'] = f"{self.accel_prefix}/{relative_path}"
+        elif gzipped:
+            response = send_from_directory(os.path.join(self.static_folder, directory), filename + '.gz',
+                                           mimetype=MIMETYPES[ext], conditional=True)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = send_from_directory(os.path.join(self.static_folder, directory), filename, conditional=True)
+
+        if ext in PRECOMPRESS_EXTENSIONS:
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+static_assets = StaticAssets()
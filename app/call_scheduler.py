@@ -0,0 +1,231 @@
+import time
+import random
+import hashlib
+import logging
+import functools
+import threading
+from app.metrics import GEMINI_TOKEN_WAIT_SECONDS
+from app.shared_state import SharedState, KEY_PREFIX
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def upstream_errors():
+    """(retryable, throttling) exception classes; google.api_core is only imported once a call fails.
+
+    Anything not retryable (bad request, auth, blocked content) fails immediately.
+    """
+    from google.api_core import exceptions as api_exceptions
+    retryable = (
+        api_exceptions.ResourceExhausted,
+        api_exceptions.TooManyRequests,
+        api_exceptions.InternalServerError,
+        api_exceptions.BadGateway,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.GatewayTimeout,
+        api_exceptions.DeadlineExceeded,
+    )
+    return retryable, (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while the Gemini circuit breaker is open"""
+
+class RateLimitTimeout(Exception):
+    """Raised when a call would wait longer than the configured queue limit for a token"""
+
+# Token bucket that lets tokens go negative: the caller reserves its slot and
+# sleeps for the returned wait instead of polling. Uses Redis time so every
+# host agrees on the clock. Returns -1 without reserving if the wait exceeds
+# the caller's limit.
+ACQUIRE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local default_rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local rate = tonumber(bucket[3]) or default_rate
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait > max_wait then
+    return '-1'
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'ts', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+# Additive-increase / multiplicative-decrease of a bucket's refill rate
+ADJUST_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[1])
+rate = math.max(tonumber(ARGV[2]), math.min(tonumber(ARGV[1]), rate * tonumber(ARGV[3]) + tonumber(ARGV[4])))
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+class LocalState:
+    """In-process scheduler state, used when Redis is not configured or unreachable"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.failures = 0
+        self.open_until = 0
+
+    def acquire(self, key, rate, burst, max_wait):
+        with self.lock:
+            now = time.time()
+            bucket = self.buckets.setdefault(key, {'tokens': burst, 'ts': now, 'rate': rate})
+            tokens = min(burst, bucket['tokens'] + max(0, now - bucket['ts']) * bucket['rate'])
+            wait = (1 - tokens) / bucket['rate'] if tokens < 1 else 0
+            if wait > max_wait:
+                return -1
+            bucket['tokens'] = tokens - 1
+            bucket['ts'] = now
+            return wait
+
+    def adjust(self, key, max_rate, min_rate, factor, increment):
+        with self.lock:
+            bucket = self.buckets.setdefault(key, {'tokens': 1, 'ts': time.time(), 'rate': max_rate})
+            bucket['rate'] = max(min_rate, min(max_rate, bucket['rate'] * factor + increment))
+            return bucket['rate']
+
+    def circuit_open_until(self):
+        return self.open_until
+
+    def record_failure(self, threshold, cooldown):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= threshold:
+                self.open_until = time.time() + cooldown
+            return self.failures
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+class RedisState:
+    """Scheduler state shared by every worker through Redis"""
+    PREFIX = KEY_PREFIX + 'gemini:'
+
+    def __init__(self, client):
+        self.client = client
+        self.acquire_script = client.register_script(ACQUIRE_SCRIPT)
+        self.adjust_script = client.register_script(ADJUST_SCRIPT)
+
+    def acquire(self, key, rate, burst, max_wait):
+        return float(self.acquire_script(keys=[self.PREFIX + 'bucket:' + key], args=[rate, burst, max_wait]))
+
+    def adjust(self, key, max_rate, min_rate, factor, increment):
+        return float(self.adjust_script(keys=[self.PREFIX + 'bucket:' + key], args=[max_rate, min_rate, factor, increment]))
+
+    def circuit_open_until(self):
+        return float(self.client.get(self.PREFIX + 'circuit:open_until') or 0)
+
+    def record_failure(self, threshold, cooldown):
+        pipe = self.client.pipeline()
+        pipe.incr(self.PREFIX + 'circuit:failures')
+        pipe.expire(self.PREFIX + 'circuit:failures', int(cooldown * 2))
+        failures = pipe.execute()[0]
+        if failures >= threshold:
+            self.client.set(self.PREFIX + 'circuit:open_until', time.time() + cooldown, ex=int(cooldown) + 1)
+        return failures
+
+    def record_success(self):
+        self.client.delete(self.PREFIX + 'circuit:failures')
+
+class CallScheduler:
+    """Shared front door for every Gemini call.
+
+    Each API key gets a token bucket whose refill rate backs off
+    multiplicatively on 429s and recovers additively on success, so
+    throughput settles just under the quota. Retryable failures are retried
+    with full-jitter exponential backoff, waiting at least as long as the
+    server's retry hint. Consecutive upstream failures open a circuit
+    breaker that fails calls fast for a cooldown period. State lives in
+    Redis so all gunicorn workers share one budget; if Redis is unavailable
+    the scheduler degrades to per-process state (see ``SharedState``).
+    """
+    def __init__(self):
+        self.rate = 5.0
+        self.min_rate = 0.2
+        self.burst = 10
+        self.max_wait = 60
+        self.max_retries = 4
+        self.backoff_base = 1.0
+        self.backoff_max = 30.0
+        self.circuit_threshold = 5
+        self.circuit_cooldown = 30
+        self.store = SharedState(LocalState(), 'Gemini scheduling')
+
+    def init_app(self, app):
+        self.rate = app.config.get('GEMINI_RATE_LIMIT', self.rate)
+        self.burst = app.config.get('GEMINI_RATE_BURST', self.burst)
+        self.max_wait = app.config.get('GEMINI_MAX_QUEUE_WAIT', self.max_wait)
+        self.max_retries = app.config.get('GEMINI_MAX_RETRIES', self.max_retries)
+        self.backoff_base = app.config.get('GEMINI_BACKOFF_BASE', self.backoff_base)
+        self.backoff_max = app.config.get('GEMINI_BACKOFF_MAX', self.backoff_max)
+        self.circuit_threshold = app.config.get('GEMINI_CIRCUIT_THRESHOLD', self.circuit_threshold)
+        self.circuit_cooldown = app.config.get('GEMINI_CIRCUIT_COOLDOWN', self.circuit_cooldown)
+        self.store.init_app(app, RedisState)
+
+    @staticmethod
+    def bucket_key(api_key):
+        return hashlib.sha256((api_key or 'default').encode()).hexdigest()[:16]
+
+    @staticmethod
+    def retry_after(error):
+        """Seconds the server asked us to wait, from gRPC RetryInfo or a Retry-After header"""
+        for detail in getattr(error, 'details', None) or ():
+            delay = getattr(detail, 'retry_delay', None)
+            if delay is not None:
+                return delay.seconds + delay.nanos / 1e9
+        headers = getattr(getattr(error, 'response', None), 'headers', None)
+        if headers and headers.get('Retry-After'):
+            try:
+                return float(headers['Retry-After'])
+            except ValueError:
+                return None
+        return None
+
+    def call(self, api_key, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) under the rate limit, retry policy and circuit breaker"""
+        key = self.bucket_key(api_key)
+        attempt = 0
+        while True:
+            if self.store.run('circuit_open_until') > time.time():
+                raise CircuitOpenError("Gemini API circuit breaker is open; failing fast")
+            wait = self.store.run('acquire', key, self.rate, self.burst, self.max_wait)
+            if wait < 0:
+                raise RateLimitTimeout(f"Gemini call would wait more than {self.max_wait}s for a rate limit token")
+            GEMINI_TOKEN_WAIT_SECONDS.observe(wait)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                result = fn(*args, **kwargs)
+            except upstream_errors()[0] as e:
+                if isinstance(e, upstream_errors()[1]):
+                    rate = self.store.run('adjust', key, self.rate, self.min_rate, 0.5, 0)
+                    logger.warning(f"Gemini throttled this key; rate lowered to {rate:.2f}/s")
+                else:
+                    failures = self.store.run('record_failure', self.circuit_threshold, self.circuit_cooldown)
+                    if failures >= self.circuit_threshold:
+                        logger.error(f"Opening Gemini circuit breaker for {self.circuit_cooldown}s after {failures} consecutive failures")
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+                delay = max(delay, self.retry_after(e) or 0)
+                logger.warning(f"Gemini call failed ({type(e).__name__}); retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.store.run('record_success')
+            self.store.run('adjust', key, self.rate, self.min_rate, 1, self.rate * 0.05)
+            return result
+
+call_scheduler = CallScheduler()
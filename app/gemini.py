@@ -0,0 +1,73 @@
+import os
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class GeminiModelPool:
+    """Thread-safe pool of Gemini clients and models keyed by API key.
+
+    ``genai.configure`` swaps a process-wide client, so concurrent requests
+    with different user keys could end up calling with each other's key.
+    Instead each key gets its own GenerativeServiceClient, whose gRPC channel
+    stays warm across calls, and models are bound to that client. The least
+    recently used keys are dropped once ``max_clients`` is exceeded; calls
+    already holding an evicted model finish normally and the channel is
+    closed when it is garbage collected. The SDK takes most of a second to
+    import, so it is loaded by the first call rather than at startup.
+    """
+    def __init__(self, max_clients=32):
+        self.max_clients = max_clients
+        self.default_api_key = None
+        self.model_factory = None  # Replaces genai.GenerativeModel when GEMINI_BACKEND names another backend
+        self.entries = OrderedDict()  # api_key -> {'client': ..., 'models': {model_name: model}}
+        self.lock = threading.Lock()
+        # gRPC channels must not be shared with a forked worker; it opens its own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.default_api_key = app.config.get('GEMINI_API_KEY')
+        self.max_clients = app.config.get('GEMINI_CLIENT_POOL_SIZE', self.max_clients)
+        backend = app.config.get('GEMINI_BACKEND') or 'gemini'
+        if backend != 'gemini':
+            # 'package.module:factory', called as factory(model_name, safety_settings=...)
+            module_name, _, attr = backend.partition(':')
+            self.model_factory = getattr(importlib.import_module(module_name), attr)
+            logger.warning(f"Gemini calls are served by {backend}, not the Gemini API")
+
+    def get_model(self, model_name, api_key=None, safety_settings=None):
+        """Return a model bound to api_key's client (or the default key's)"""
+        api_key = api_key or self.default_api_key or os.environ.get('GEMINI_API_KEY')
+        with self.lock:
+            entry = self.entries.get(api_key)
+            if entry is None:
+                client = None
+                if self.model_factory is None:
+                    import google.ai.generativelanguage as glm
+                    client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+                entry = {'client': client, 'models': {}}
+                self.entries[api_key] = entry
+                while len(self.entries) > self.max_clients:
+                    self.entries.popitem(last=False)
+                    logger.info("Evicted least recently used Gemini client")
+            else:
+                self.entries.move_to_end(api_key)
+            model = entry['models'].get(model_name)
+            if model is None:
+                if self.model_factory:
+                    model = self.model_factory(model_name, safety_settings=safety_settings)
+                else:
+                    import google.generativeai as genai
+                    model = genai.GenerativeModel(model_name, safety_settings=safety_settings)
+                    # google-generativeai 0.3 only exposes the global client; bind ours directly
+                    model._client = entry['client']
+                entry['models'][model_name] = model
+            return model
+
+model_pool = GeminiModelPool()
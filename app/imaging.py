@@ -0,0 +1,179 @@
+import io
+import os
+import math
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+API_MAX_WIDTH = 400  # Width of the JPEG sent to the vision API
+API_JPEG_QUALITY = 70
+EXIF_ORIENTATION = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)  # EXIF orientations that swap width and height
+HASH_SIZE = 8  # dHash grid; yields a 64-bit perceptual hash
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def dhash(img):
+    """64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its left neighbour"""
+    small = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def cluster_near_duplicates(hashes, threshold):
+    """Group hashes within ``threshold`` Hamming distance of a cluster's first member.
+
+    Clusters are formed greedily in input order, so each cluster's
+    representative is its earliest image. Returns lists of indices into
+    ``hashes``, representative first.
+    """
+    values = np.array(hashes, dtype=np.uint64)
+    assigned = np.zeros(len(values), dtype=bool)
+    clusters = []
+    for index in range(len(values)):
+        if assigned[index]:
+            continue
+        distances = POPCOUNT[(values ^ values[index]).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        members = np.flatnonzero(~assigned & (distances <= threshold))
+        assigned[members] = True
+        clusters.append(members.tolist())
+    return clusters
+
+def _scale_to_fit(size, max_width=None, max_size=None):
+    """Downscale factor (<= 1) that thumbnail() will apply for the given bounds"""
+    width, height = size
+    scale = 1.0
+    if max_width:
+        scale = min(scale, max_width / width)
+    if max_size:
+        scale = min(scale, max_size / width, max_size / height)
+    return scale
+
+def preprocess_image(image_path, display_path=None, display_max_size=1600, display_quality=82):
+    """Decode an image once and derive everything the pipeline needs from it.
+
+    JPEGs are decoded in draft mode, letting libjpeg scale by 1/2, 1/4 or 1/8
+    during decode so a 20MP photo never materializes at full resolution. EXIF
+    orientation is applied before resizing. The result is the API payload
+    (RGB JPEG, at most 400px wide), a perceptual hash of it and, when
+    ``display_path`` is given, a web-sized display derivative written there
+    for the slideshow.
+    """
+    with Image.open(image_path) as img:
+        original_size = img.size
+        width, height = original_size
+        if img.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+
+        # Decode no larger than the biggest output needs
+        scale = _scale_to_fit((width, height), max_width=API_MAX_WIDTH)
+        if display_path:
+            scale = max(scale, _scale_to_fit((width, height), max_size=display_max_size))
+        draft_size = (math.ceil(original_size[0] * scale), math.ceil(original_size[1] * scale))
+        img.draft('RGB', draft_size)
+
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        logger.debug(f"Decoded {image_path} at {img.size} (original {original_size})")
+
+        display_size = None
+        if display_path:
+            display = img.copy()
+            display.thumbnail((display_max_size, display_max_size), Image.LANCZOS)
+            display.save(display_path, format='JPEG', quality=display_quality, optimize=True, progressive=True)
+            display_size = display.size
+            # The display derivative is already smaller; resize the API image from it when it is wide enough
+            if display.width >= min(API_MAX_WIDTH, img.width):
+                img = display
+
+        if img.width > API_MAX_WIDTH:
+            img = img.copy()
+            img.thumbnail((API_MAX_WIDTH, API_MAX_WIDTH * 10), Image.LANCZOS)  # maintain aspect ratio
+        api_bytes = io.BytesIO()
+        img.save(api_bytes, format='JPEG', quality=API_JPEG_QUALITY)
+
+        phash = dhash(img)
+
+    return {
+        'api_bytes': api_bytes.getvalue(),
+        'original_size': original_size,
+        'api_size': img.size,
+        'display_size': display_size,
+        'phash': phash
+    }
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class ImagePreprocessor:
+    """Runs preprocess_image in-process or on a process pool.
+
+    Decoding and resizing are CPU-bound and hold the GIL, so with the
+    ``process`` backend they run in worker processes sized to the available
+    cores while the Gemini calls stay on the caller's threads. Workers write
+    the display derivative themselves and send back only the encoded API
+    bytes. If the pool cannot start or breaks, work falls back to in-process
+    execution. Settings live here so worker threads need no app context.
+    """
+    def __init__(self):
+        self.display_max_size = 1600
+        self.display_quality = 82
+        self.backend = 'thread'
+        self.max_workers = None
+        self.pool = None
+        self.forked = False
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent's pool belongs to the parent; a forked worker starts its own on first use.
+        # The inherited forkserver is not this process's child, so the worker spawns instead.
+        self.pool = None
+        self.forked = True
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.display_max_size = app.config.get('DISPLAY_MAX_SIZE', self.display_max_size)
+        self.display_quality = app.config.get('DISPLAY_JPEG_QUALITY', self.display_quality)
+        self.backend = app.config.get('PREPROCESS_BACKEND', self.backend)
+        self.max_workers = app.config.get('PREPROCESS_WORKERS') or available_cpus()
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None and self.backend == 'process':
+                try:
+                    # Never fork a multi-threaded server process; forkserver children start clean
+                    forkserver = not self.forked and 'forkserver' in multiprocessing.get_all_start_methods()
+                    method = 'forkserver' if forkserver else 'spawn'
+                    self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(method))
+                    logger.info(f"Image preprocessing pool started with {self.max_workers} {method} workers")
+                except (OSError, ValueError) as e:
+                    logger.error(f"Could not start preprocessing pool, using in-process decoding: {str(e)}")
+                    self.backend = 'thread'
+            return self.pool
+
+    def preprocess(self, image_path, display_path=None):
+        args = (image_path, display_path, self.display_max_size, self.display_quality)
+        pool = self._get_pool()
+        if pool is not None:
+            try:
+                return pool.submit(preprocess_image, *args).result()
+            except BrokenProcessPool as e:
+                logger.error(f"Preprocessing pool broke, falling back to in-process decoding: {str(e)}")
+                with self.lock:
+                    if self.pool is pool:
+                        self.pool = None
+                        self.backend = 'thread'
+                pool.shutdown(wait=False)
+        return preprocess_image(*args)
+
+image_preprocessor = ImagePreprocessor()
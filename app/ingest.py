@@ -0,0 +1,124 @@
+import os
+import shutil
+import zipfile
+import logging
+import posixpath
+from werkzeug.utils import secure_filename
+from app.metrics import metrics, BYTES_WRITTEN
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+IMAGE_MIME_TYPES = ('image/jpeg', 'image/png')
+SNIFF_BYTES = 2048  # Enough of the header for libmagic to identify JPEG/PNG
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class UnsafeArchiveError(Exception):
+    """Raised when an uploaded archive exceeds the configured extraction limits"""
+
+def sniff_mime_type(head):
+    """MIME type of a file from its first bytes; libmagic is loaded on first use, not at import"""
+    import magic
+    return magic.from_buffer(head, mime=True)
+
+def is_image_name(name):
+    """Whether an archive member path names an image worth extracting"""
+    basename = posixpath.basename(name)
+    # Skip macOS resource forks and metadata folders
+    if basename.startswith('._') or name.startswith('__MACOSX/'):
+        return False
+    return basename.lower().endswith(IMAGE_EXTENSIONS)
+
+def is_image_member(info):
+    """Cheap name-based filter applied before any member bytes are read"""
+    if info.is_dir():
+        return False
+    return is_image_name(info.filename)
+
+def count_image_members(path):
+    """Image members an archive lists in its central directory, without reading them; 0 if it is no zip"""
+    try:
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            return sum(1 for info in zip_ref.infolist() if is_image_member(info))
+    except (zipfile.BadZipFile, OSError):
+        return 0
+
+@metrics.timed('unzip')
+def extract_zip_images(source, dest_dir, story_id, start_index=1,
+                       max_members=2000, max_total_size=1024 * 1024 * 1024, max_member_size=100 * 1024 * 1024):
+    """Stream image members of a zip straight to their final slide paths.
+
+    ``source`` is a path or seekable file object (such as the upload stream).
+    Only members with an image extension whose leading bytes sniff as JPEG
+    or PNG are written, each exactly once, as ``{n}_{name}`` in dest_dir.
+    Member count and uncompressed size caps are checked against the central
+    directory up front and enforced again while streaming, since declared
+    sizes cannot be trusted.
+    """
+    images = []
+    with zipfile.ZipFile(source, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+        if len(infos) > max_members:
+            raise UnsafeArchiveError(f"Archive has {len(infos)} members; the limit is {max_members}")
+        members = sorted((info for info in infos if is_image_member(info)), key=lambda info: info.filename)
+        declared_size = sum(info.file_size for info in members)
+        if declared_size > max_total_size:
+            raise UnsafeArchiveError(f"Archive images expand to {declared_size} bytes; the limit is {max_total_size}")
+
+        total_written = 0
+        for info in members:
+            if info.file_size > max_member_size:
+                logger.warning(f"Skipping oversized archive member {info.filename} ({info.file_size} bytes)")
+                continue
+            filename = secure_filename(posixpath.basename(info.filename))
+            static_image_name = f"{start_index + len(images)}_{filename}"
+            static_image_path = os.path.join(dest_dir, static_image_name)
+            with zip_ref.open(info) as member:
+                head = member.read(SNIFF_BYTES)
+                mime_type = sniff_mime_type(head)
+                if mime_type not in IMAGE_MIME_TYPES:
+                    logger.warning(f"Skipping archive member {info.filename}: content is {mime_type}")
+                    continue
+                written = 0
+                with open(static_image_path, 'wb') as out:
+                    chunk = head
+                    while chunk:
+                        written += len(chunk)
+                        if written > info.file_size or written > max_member_size or total_written + written > max_total_size:
+                            out.close()
+                            os.remove(static_image_path)
+                            raise UnsafeArchiveError(f"Archive member {info.filename} expands beyond its declared size")
+                        out.write(chunk)
+                        chunk = member.read(COPY_CHUNK_SIZE)
+            total_written += written
+            images.append({
+                'filename': filename,
+                'path': static_image_path,
+                'image_url': f"/static/stories/{story_id}/temp_images/{static_image_name}"
+            })
+    BYTES_WRITTEN.inc(total_written, kind='extracted')
+    logger.info(f"Extracted {len(images)} images ({total_written} bytes) from archive")
+    return images
+
+def place_uploads(uploads, dest_dir, story_id, **limits):
+    """Turn uploads saved by a request into slide images, in upload order.
+
+    Archives are extracted with extract_zip_images, which gets ``limits``,
+    and then deleted; any other upload is an image and is moved into
+    dest_dir as ``{n}_{name}``.
+    """
+    images = []
+    for upload in uploads:
+        if upload['filename'].lower().endswith('.zip'):
+            images.extend(extract_zip_images(upload['path'], dest_dir, story_id, start_index=len(images) + 1, **limits))
+            os.remove(upload['path'])
+            continue
+        static_image_name = f"{len(images) + 1}_{upload['filename']}"
+        static_image_path = os.path.join(dest_dir, static_image_name)
+        shutil.move(upload['path'], static_image_path)
+        images.append({
+            'filename': upload['filename'],
+            'path': static_image_path,
+            'image_url': f"/static/stories/{story_id}/temp_images/{static_image_name}"
+        })
+    return images
@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.metrics import metrics, IMAGES
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATES = ('done', 'error')
+ORPHANED_ERROR = 'The story job stopped unexpectedly; please try again'
+
+class Job:
+    """In-memory state for a story job running in this process"""
+    def __init__(self, story_id, story_dir):
+        self.story_id = story_id
+        self.story_dir = story_dir
+        self.status = 'queued'
+        self.images = []  # [{'filename': ..., 'stage': ...}] in upload order
+        self.error = None
+        self.result = None
+        self.pid = os.getpid()
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.heartbeat_at = self.created_at
+        self.next_event_id = 0
+        self.snapshot_written_at = 0
+
+    def snapshot(self):
+        completed = sum(1 for image in self.images if image['stage'] in ('done', 'failed', 'duplicate'))
+        return {
+            'story_id': self.story_id,
+            'status': self.status,
+            'total_images': len(self.images),
+            'completed_images': completed,
+            'images': self.images,
+            'error': self.error,
+            'result': self.result,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'pid': self.pid,
+            'heartbeat_at': self.heartbeat_at
+        }
+
+class JobTracker:
+    """Runs story jobs on a background executor and records their progress.
+
+    Every state change is appended to ``events.jsonl`` in the story directory
+    and a throttled snapshot is written to ``job.json``, so status and event
+    streams can be served by any worker process on the host, not just the one
+    running the job.
+
+    The snapshot names the owning process and carries a heartbeat that is
+    refreshed every ``HEARTBEAT_INTERVAL`` seconds while the job is
+    unfinished. A job whose owner has exited, or whose heartbeat is older
+    than ``HEARTBEAT_TIMEOUT``, will never finish, so other processes report
+    it as an error instead of waiting on it forever.
+    """
+    SNAPSHOT_INTERVAL = 0.5  # Seconds between job.json rewrites while running
+    POLL_INTERVAL = 0.5  # Seconds between event log checks while streaming
+    KEEPALIVE_INTERVAL = 15  # Seconds between SSE keep-alive comments
+    HEARTBEAT_INTERVAL = 10  # Seconds between heartbeat rewrites of job.json
+    HEARTBEAT_TIMEOUT = 60  # Seconds without a heartbeat before a job counts as orphaned
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.executor = None
+        self.heartbeat = None
+        self.max_workers = 4
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        """A forked worker (e.g. gunicorn --preload) has none of the parent's executor threads or jobs"""
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.executor = None
+        self.heartbeat = None
+
+    def init_app(self, app):
+        self.max_workers = app.config.get('JOB_MAX_WORKERS', self.max_workers)
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='story-job')
+                logger.info(f"Story job executor started with {self.max_workers} workers")
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+                self.heartbeat.start()
+            return self.executor
+
+    def _beat(self):
+        """Refresh the heartbeat in job.json of every unfinished job in this process"""
+        while True:
+            time.sleep(self.HEARTBEAT_INTERVAL)
+            with self.lock:
+                for job in list(self.jobs.values()):
+                    job.heartbeat_at = time.time()
+                    try:
+                        self._write_snapshot(job)
+                    except OSError as e:
+                        logger.error(f"Could not record heartbeat for job {job.story_id}: {str(e)}")
+
+    def submit(self, story_id, story_dir, fn, *args):
+        """Register a job and run fn(job, *args) on the background executor"""
+        job = Job(story_id, story_dir)
+        with self.lock:
+            self.jobs[story_id] = job
+            # A story can be written again (see regenerate); its event log starts over with the new job
+            try:
+                os.remove(os.path.join(story_dir, 'events.jsonl'))
+            except FileNotFoundError:
+                pass
+            self._record(job, 'status', {'status': job.status}, force_snapshot=True)
+        self._get_executor().submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        try:
+            fn(job, *args)
+        except Exception as e:
+            logger.error(f"Story job {job.story_id} failed: {str(e)}")
+            self.fail(job, str(e))
+
+    def set_status(self, job, status):
+        with self.lock:
+            job.status = status
+            self._record(job, 'status', {'status': status}, force_snapshot=True)
+
+    def set_images(self, job, filenames):
+        with self.lock:
+            job.images = [{'filename': filename, 'stage': 'queued'} for filename in filenames]
+            self._record(job, 'images', {'filenames': filenames}, force_snapshot=True)
+
+    def image_stage(self, job, index, stage):
+        if stage in ('done', 'failed', 'duplicate'):
+            IMAGES.inc(stage=stage)
+        with self.lock:
+            job.images[index]['stage'] = stage
+            self._record(job, 'image', {
+                'index': index,
+                'filename': job.images[index]['filename'],
+                'stage': stage
+            })
+
+    def emit(self, job, event, data):
+        """Record a free-form event for stream consumers"""
+        with self.lock:
+            self._record(job, event, data)
+
+    def finish(self, job, result):
+        with self.lock:
+            job.status = 'done'
+            job.result = result
+            self._record(job, 'done', result, force_snapshot=True)
+            self.jobs.pop(job.story_id, None)
+
+    def fail(self, job, error):
+        with self.lock:
+            job.status = 'error'
+            job.error = error
+            self._record(job, 'error', {'error': error}, force_snapshot=True)
+            self.jobs.pop(job.story_id, None)
+
+    def _record(self, job, event, data, force_snapshot=False):
+        """Append an event to the job's log; caller must hold self.lock"""
+        job.updated_at = time.time()
+        entry = {'id': job.next_event_id, 'event': event, 'data': data}
+        job.next_event_id += 1
+        try:
+            with open(os.path.join(job.story_dir, 'events.jsonl'), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            if force_snapshot or job.updated_at - job.snapshot_written_at >= self.SNAPSHOT_INTERVAL:
+                self._write_snapshot(job)
+        except OSError as e:
+            logger.error(f"Could not record event for job {job.story_id}: {str(e)}")
+        self.changed.notify_all()
+
+    def _write_snapshot(self, job):
+        job_file = os.path.join(job.story_dir, 'job.json')
+        tmp_file = job_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(job.snapshot(), f)
+        os.replace(tmp_file, job_file)
+        job.snapshot_written_at = job.updated_at
+
+    def state_counts(self):
+        """Jobs in this process by status, for the queue depth gauge"""
+        counts = {}
+        with self.lock:
+            for job in self.jobs.values():
+                counts[(job.status,)] = counts.get((job.status,), 0) + 1
+        return counts
+
+    def orphaned(self, snapshot):
+        """True if an unfinished job's owner has exited or stopped refreshing its heartbeat"""
+        if snapshot.get('status') in TERMINAL_STATES:
+            return False
+        heartbeat_at = snapshot.get('heartbeat_at') or snapshot.get('updated_at') or 0
+        if time.time() - heartbeat_at > self.HEARTBEAT_TIMEOUT:
+            return True
+        pid = snapshot.get('pid')
+        if pid is None or pid == os.getpid():
+            # This process only knows its own jobs from memory, so one on disk alone was lost
+            return pid == os.getpid() and snapshot['story_id'] not in self.jobs
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass  # Alive, owned by another user
+        return False
+
+    def get_status(self, story_id, story_dir):
+        """Return the job snapshot from memory, or from job.json if another process owns it.
+
+        A job orphaned by its owner is reported with status ``error``.
+        """
+        with self.lock:
+            job = self.jobs.get(story_id)
+            if job is not None:
+                return job.snapshot()
+        try:
+            with open(os.path.join(story_dir, 'job.json'), 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.orphaned(snapshot):
+            snapshot.update(status='error', error=ORPHANED_ERROR)
+        return snapshot
+
+    def stream(self, story_id, story_dir, last_event_id=-1):
+        """Yield Server-Sent-Events for a job, starting after last_event_id"""
+        events_file = os.path.join(story_dir, 'events.jsonl')
+        offset = 0
+        buffer = ''
+        last_sent = time.time()
+        while True:
+            finished = False
+            try:
+                with open(events_file, 'r') as f:
+                    f.seek(offset)
+                    chunk = f.read()
+                    offset = f.tell()
+            except OSError:
+                chunk = ''
+            buffer += chunk
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                if not line:
+                    continue
+                entry = json.loads(line)
+                if entry['event'] in TERMINAL_STATES:
+                    finished = True
+                if entry['id'] <= last_event_id:
+                    continue
+                last_sent = time.time()
+                yield f"id: {entry['id']}\nevent: {entry['event']}\ndata: {json.dumps(entry['data'])}\n\n"
+            if finished:
+                return
+            if time.time() - last_sent >= self.KEEPALIVE_INTERVAL:
+                last_sent = time.time()
+                status = self.get_status(story_id, story_dir)
+                if status is not None and status['status'] == 'error' and status['error'] == ORPHANED_ERROR:
+                    yield f"event: error\ndata: {json.dumps({'error': ORPHANED_ERROR})}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+            with self.changed:
+                self.changed.wait(self.POLL_INTERVAL)
+
+job_tracker = JobTracker()
+
+metrics.gauge('photoyarn_jobs', 'Story jobs in this process by status; queued jobs wait for an executor slot',
+              ['status'], callback=job_tracker.state_counts)
@@ -0,0 +1,250 @@
+import os
+import time
+import random
+import functools
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from flask import g, request
+from app.structured_log import log_event
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base for labelled metrics; values are kept per label tuple"""
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """A gauge set directly, or computed at scrape time by ``callback`` returning {label tuple: value}"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception as e:
+                logger.warning(f"Could not collect {self.name}: {str(e)}")
+                values = {}
+            with self.lock:
+                self.values = dict(values)
+        return super().render()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def _render_value(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['counts']):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+class MetricsRegistry:
+    """Process-local metrics in the Prometheus text format, plus lightweight tracing.
+
+    Each worker process keeps and serves its own values, so scrape every
+    worker (or run one worker per port) to see the whole host. ``span()``
+    times a pipeline stage into ``photoyarn_stage_seconds``; when a trace is
+    active and sampled (TRACE_SAMPLE_RATE), every span is also logged as a
+    structured ``span`` event with trace, span and parent ids, so one
+    upload's stages can be followed end to end.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.enabled = True
+        self.trace_sample_rate = 0.0
+        self.current_span = contextvars.ContextVar('current_span', default=None)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.trace_sample_rate = app.config.get('TRACE_SAMPLE_RATE', self.trace_sample_rate)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        g._request_start = time.perf_counter()
+        # Continue the caller's trace when it sends a W3C traceparent header
+        parts = request.headers.get('traceparent', '').split('-')
+        if len(parts) == 4 and len(parts[1]) == 32:
+            token = self.current_span.set({'trace_id': parts[1], 'span_id': parts[2], 'sampled': parts[3] == '01'})
+        else:
+            token = self.start_trace()
+        g._trace_token = token
+
+    def _after_request(self, response):
+        if self.enabled and hasattr(g, '_request_start'):
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g._request_start,
+                                         endpoint=request.endpoint or 'unmatched',
+                                         method=request.method,
+                                         status=response.status_code)
+        return response
+
+    def _teardown_request(self, error=None):
+        token = g.pop('_trace_token', None)
+        if token is not None:
+            try:
+                self.end_trace(token)
+            except ValueError:
+                pass  # Token from another context, e.g. a streamed response finishing elsewhere
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        return self._register(Gauge(name, documentation, labels, callback))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def start_trace(self, trace_id=None):
+        """Begin a trace in the current context; returns a token for end_trace"""
+        sampled = self.trace_sample_rate > 0 and random.random() < self.trace_sample_rate
+        root = {'trace_id': trace_id or os.urandom(16).hex(), 'span_id': None, 'sampled': sampled}
+        return self.current_span.set(root)
+
+    def end_trace(self, token):
+        self.current_span.reset(token)
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """Time a stage into photoyarn_stage_seconds and, if traced, log it as a span"""
+        parent = self.current_span.get()
+        current = None
+        token = None
+        if parent is not None:
+            current = {'trace_id': parent['trace_id'], 'span_id': os.urandom(8).hex(), 'sampled': parent['sampled']}
+            token = self.current_span.set(current)
+        start_time = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            if token is not None:
+                self.current_span.reset(token)
+            if self.enabled:
+                STAGE_SECONDS.observe(elapsed, stage=stage)
+            if current is not None and current['sampled']:
+                log_event(logger, 'span',
+                          trace_id=current['trace_id'],
+                          span_id=current['span_id'],
+                          parent_id=parent['span_id'],
+                          stage=stage,
+                          duration_ms=round(elapsed * 1000, 2),
+                          error=error,
+                          **attributes)
+
+    def timed(self, stage):
+        """Decorator form of span()"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def propagate(self, fn):
+        """Wrap fn so it runs in a copy of the caller's trace context, e.g. on executor threads"""
+        context = contextvars.copy_context()
+        def run(*args, **kwargs):
+            return context.copy().run(fn, *args, **kwargs)
+        return run
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram('photoyarn_stage_seconds', 'Duration of upload pipeline stages', ['stage'])
+HTTP_REQUEST_SECONDS = metrics.histogram('photoyarn_http_request_seconds', 'HTTP request latency', ['endpoint', 'method', 'status'])
+GEMINI_CALLS = metrics.counter('photoyarn_gemini_calls_total', 'Gemini requests by kind and outcome', ['kind', 'outcome'])
+GEMINI_TOKENS = metrics.counter('photoyarn_gemini_tokens_total', 'Tokens reported by Gemini responses', ['kind'])
+GEMINI_TOKEN_WAIT_SECONDS = metrics.histogram('photoyarn_gemini_token_wait_seconds', 'Time Gemini calls waited for a rate limit token')
+CACHE_LOOKUPS = metrics.counter('photoyarn_analysis_cache_lookups_total', 'Analysis cache lookups', ['result'])
+BYTES_WRITTEN = metrics.counter('photoyarn_bytes_written_total', 'Bytes written to disk by the pipeline', ['kind'])
+IMAGES = metrics.counter('photoyarn_images_total', 'Images by final analysis stage', ['stage'])
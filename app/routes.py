@@ -1,163 +1,443 @@
 import os
 import zipfile
+import functools
 import base64
-from flask import Blueprint, render_template, request, jsonify, current_app
+from flask import Blueprint, render_template, request, jsonify, current_app, Response, url_for
 from werkzeug.utils import secure_filename
-import google.generativeai as genai
-from PIL import Image
-import io
 import json
 import logging
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from shutil import copyfile
+import shutil
 import re
-from dotenv import load_dotenv
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-import redis
 import uuid
 from datetime import datetime
-import magic
-import threading
 import time
-from queue import Queue
-import heapq
+from concurrent.futures import ThreadPoolExecutor
+from app.jobs import job_tracker, TERMINAL_STATES
+from app.analysis_cache import analysis_cache
+from app.ingest import count_image_members, place_uploads, UnsafeArchiveError
+from app.imaging import image_preprocessor, cluster_near_duplicates
+from app.gemini import model_pool
+from app.call_scheduler import call_scheduler
+from app.story_index import story_index
+from app.story_store import story_store
+from app.assets import static_assets, fingerprint_file, FINGERPRINTED_IMAGE
+from app.uploads import chunked_uploads, UploadError
+from app.admission import admission, AdmissionRejected
+from app.structured_log import log_event
+from app.metrics import metrics, GEMINI_CALLS, GEMINI_TOKENS, CACHE_LOOKUPS, BYTES_WRITTEN
 
-# Load environment variables from .env
-load_dotenv()
-
-# Configure logging
-logging.basicConfig(filename='/var/log/photoyarn/app.log', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 main = Blueprint('main', __name__)
 
-# Configure Google Gemini API
-DEFAULT_GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-genai.configure(api_key=DEFAULT_GEMINI_API_KEY)
-
-# Configure safety settings
+# Configure safety settings; names rather than SDK enums, so the SDK is not imported with the routes
 safety_settings = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
+    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
+    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
 }
 
-# Set up Redis for rate limiting
-REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# Model and prompt used for per-image analysis; both are part of the analysis cache key
+ANALYSIS_MODEL = 'gemini-1.5-flash'
+ANALYSIS_PROMPT = "Analyze this image. Describe the primary subjects, the setting, and any actions taking place. Focus on objective details relevant for storytelling."
+
+# Multi-image variant of ANALYSIS_PROMPT used when batching; asks for per-image JSON keyed by position
+BATCH_ANALYSIS_PROMPT = """You are given {count} images, numbered 1 to {count} in the order they appear. For each image: """ + ANALYSIS_PROMPT + """
+
+Respond with only a JSON object that maps each image number (as a string) to its description, for example {{"1": "...", "2": "..."}}."""
+
+# Model used to write the story from the image summaries
+STORY_MODEL = 'gemini-1.5-flash'
+
+# Rate limits are stored in Redis; the storage is set up from RATELIMIT_STORAGE_URI by init_app
 limiter = Limiter(
     key_func=get_remote_address,
-    storage_uri=REDIS_URL,
     default_limits=[]
 )
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
-def process_image(image_path, api_key=None):
-    """Process a single image using Gemini Vision API"""
+def prepare_image(image_path, display_path=None):
+    """Preprocess an image and look it up in the analysis cache.
+
+    Returns the preprocess_image result plus 'cache_key' and 'summary'
+    (the cached summary, or None on a miss).
+    """
+    start_time = time.time()
+    # Decode once: API payload plus the web-sized display derivative
+    with metrics.span('decode', file=os.path.basename(image_path)):
+        preprocessed = image_preprocessor.preprocess(image_path, display_path)
+    if preprocessed['display_size']:
+        BYTES_WRITTEN.inc(os.path.getsize(display_path), kind='display')
+    # Reuse an earlier analysis of the same normalized image if we have one
+    preprocessed['cache_key'] = analysis_cache.make_key(preprocessed['api_bytes'], ANALYSIS_MODEL, ANALYSIS_PROMPT)
+    preprocessed['summary'] = analysis_cache.get(preprocessed['cache_key'])
+    CACHE_LOOKUPS.inc(result='miss' if preprocessed['summary'] is None else 'hit')
+    log_event(logger, 'image_prepared', sampled=True,
+              file=os.path.basename(image_path),
+              original_size=preprocessed['original_size'],
+              api_size=preprocessed['api_size'],
+              display_size=preprocessed['display_size'],
+              api_bytes=len(preprocessed['api_bytes']),
+              cache_hit=preprocessed['summary'] is not None,
+              elapsed_ms=round((time.time() - start_time) * 1000, 1))
+    return preprocessed
+
+def response_token_count(response):
+    """Token count reported on the first candidate, if the SDK provides one"""
+    candidates = getattr(response, 'candidates', None)
+    if candidates:
+        return getattr(candidates[0], 'token_count', None)
+    return None
+
+def record_gemini_call(kind, outcome, response=None):
+    """Count a Gemini request and the tokens it reported"""
+    GEMINI_CALLS.inc(kind=kind, outcome=outcome)
+    tokens = response_token_count(response) if response is not None else None
+    if isinstance(tokens, dict):
+        tokens = tokens.get('total')
+    if isinstance(tokens, int) and tokens > 0:
+        GEMINI_TOKENS.inc(tokens, kind=kind)
+
+def analyze_image_bytes(img_byte_arr, api_key=None, cache_key=None):
+    """Send one preprocessed JPEG to Gemini Vision API and cache the summary"""
+    # Use the provided API key if present, else default
+    model = model_pool.get_model(ANALYSIS_MODEL, api_key, safety_settings)
+    request_content = [
+        ANALYSIS_PROMPT,
+        {"mime_type": "image/jpeg", "data": base64.b64encode(img_byte_arr).decode()}
+    ]
+    start_time = time.time()
+    try:
+        with metrics.span('vision', image_bytes=len(img_byte_arr)):
+            response = call_scheduler.call(api_key, model.generate_content, request_content)
+    except Exception as api_error:
+        record_gemini_call('vision', 'error')
+        log_event(logger, 'vision_call_failed', logging.ERROR,
+                  model=ANALYSIS_MODEL,
+                  image_bytes=len(img_byte_arr),
+                  elapsed_ms=round((time.time() - start_time) * 1000, 1),
+                  error_type=type(api_error).__name__,
+                  error=str(api_error))
+        return None
+
+    text = None
     try:
-        # Skip macOS metadata files
-        if os.path.basename(image_path).startswith('._'):
-            logger.info(f"Skipping macOS metadata file: {os.path.basename(image_path)}")
+        text = response.text
+    except ValueError:
+        pass  # No text parts, e.g. the response was blocked
+    log_event(logger, 'vision_call', sampled=True,
+              model=ANALYSIS_MODEL,
+              image_bytes=len(img_byte_arr),
+              elapsed_ms=round((time.time() - start_time) * 1000, 1),
+              block_reason=str(response.prompt_feedback.block_reason) if response.prompt_feedback and response.prompt_feedback.block_reason else None,
+              finish_reason=str(response.candidates[0].finish_reason) if response.candidates else None,
+              tokens=response_token_count(response),
+              response_chars=len(text) if text else 0,
+              response=text)
+    record_gemini_call('vision', 'ok' if text else 'empty', response)
+    if not text:
+        logger.error("Gemini API returned empty response text")
+        return None
+    if cache_key:
+        analysis_cache.put(cache_key, text)
+    return text
+
+def extract_json_object(text):
+    """Parse the JSON object in a model response, or return None"""
+    text = text.strip()
+    # Tolerate markdown code fences or chatter around the JSON object
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def parse_batch_response(text, count):
+    """Parse a batched analysis response into a {position: description} dict (1-based)"""
+    data = extract_json_object(text)
+    if data is None:
+        return {}
+    descriptions = {}
+    for position in range(1, count + 1):
+        description = data.get(str(position))
+        if isinstance(description, str) and description.strip():
+            descriptions[position] = description.strip()
+    return descriptions
+
+def analyze_image_batch(batch, api_key=None):
+    """Analyze several preprocessed images in one Gemini request.
+
+    ``batch`` is a list of (api_bytes, cache_key) pairs. Returns a list of
+    descriptions in the same order. Images the batch response does not cover
+    (or the whole batch, if the response cannot be parsed) are retried one
+    request per image.
+    """
+    descriptions = {}
+    try:
+        model = model_pool.get_model(ANALYSIS_MODEL, api_key, safety_settings)
+        request_content = [BATCH_ANALYSIS_PROMPT.format(count=len(batch))]
+        for img_byte_arr, _ in batch:
+            request_content.append({"mime_type": "image/jpeg", "data": base64.b64encode(img_byte_arr).decode()})
+        start_time = time.time()
+        try:
+            with metrics.span('vision_batch', images=len(batch)):
+                response = call_scheduler.call(api_key, model.generate_content, request_content)
+        except Exception:
+            record_gemini_call('vision_batch', 'error')
+            raise
+        descriptions = parse_batch_response(response.text, len(batch))
+        record_gemini_call('vision_batch', 'ok' if descriptions else 'unparsed', response)
+        log_event(logger, 'vision_batch_call', sampled=True,
+                  model=ANALYSIS_MODEL,
+                  images=len(batch),
+                  image_bytes=sum(len(img_byte_arr) for img_byte_arr, _ in batch),
+                  elapsed_ms=round((time.time() - start_time) * 1000, 1),
+                  tokens=response_token_count(response),
+                  described=len(descriptions))
+    except Exception as e:
+        logger.error(f"Batched analysis of {len(batch)} images failed: {str(e)}")
+
+    summaries = []
+    for position, (img_byte_arr, cache_key) in enumerate(batch, 1):
+        description = descriptions.get(position)
+        if description is not None:
+            analysis_cache.put(cache_key, description)
+        else:
+            logger.warning(f"Batch response missing image {position} of {len(batch)}; analyzing it individually")
+            description = analyze_image_bytes(img_byte_arr, api_key, cache_key)
+        summaries.append(description)
+    return summaries
+
+def pack_batches(items, max_bytes):
+    """Group (index, api_bytes, cache_key) items into consecutive batches under max_bytes of image payload"""
+    batches = []
+    current = []
+    current_bytes = 0
+    for item in items:
+        size = len(item[1])
+        if current and current_bytes + size > max_bytes:
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(item)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+def analyze_images(images, api_key=None, max_workers=None, on_progress=None, batch_bytes=None, dedup_threshold=None, client=None):
+    """Run the analysis stage over images on a bounded thread pool.
+
+    Every image is first preprocessed and checked against the analysis cache.
+    With ``dedup_threshold`` (DEDUP_HAMMING_THRESHOLD, negative disables)
+    near-duplicate images are clustered by perceptual hash and only each
+    cluster's first image is analyzed; the others are marked with
+    ``image['duplicate_of']`` (the representative's index) and get no
+    summary. If a representative's analysis fails, the next image of its
+    cluster takes its place and is analyzed instead. Remaining cache misses
+    are sent one request per image or, with ``batch_bytes``
+    (BATCH_ANALYSIS_MAX_BYTES), packed into multi-image requests of up to
+    that many bytes of image payload.
+
+    Returns a list of summaries (or None for failures and duplicates) in the
+    same order as ``images`` so that [IMAGE N] numbering stays stable
+    regardless of which API call finishes first. ``on_progress(index, stage)``
+    is called as each image starts and finishes. Each preparation and each
+    request waits for a slot from the admission scheduler on behalf of
+    ``client``, so concurrent jobs share the workers fairly.
+    """
+    if not images:
+        return []
+    if max_workers is None:
+        max_workers = current_app.config.get('ANALYSIS_MAX_WORKERS', 8)
+    if batch_bytes is None:
+        batch_bytes = current_app.config.get('BATCH_ANALYSIS_MAX_BYTES', 0)
+    if dedup_threshold is None:
+        dedup_threshold = current_app.config.get('DEDUP_HAMMING_THRESHOLD', -1)
+    max_workers = max(1, min(int(max_workers), len(images)))
+    logger.info(f"Analyzing {len(images)} images with {max_workers} workers")
+    summaries = [None] * len(images)
+
+    def finish(index, summary):
+        summaries[index] = summary
+        if on_progress:
+            on_progress(index, 'done' if summary else 'failed')
+
+    def prepare(indexed_image):
+        index, image = indexed_image
+        if on_progress:
+            on_progress(index, 'analyzing')
+        try:
+            # Skip macOS metadata files
+            if os.path.basename(image['path']).startswith('._'):
+                return None
+            with admission.slot(client):
+                return prepare_image(image['path'], image.get('display_path'))
+        except Exception as e:
+            logger.error(f"Error processing image {image['path']}: {str(e)}")
             return None
-        logger.info(f"Processing image: {os.path.basename(image_path)}")
-        with Image.open(image_path) as img:
-            logger.info(f"Image loaded successfully. Original size: {img.size}")
-            # Use thumbnail for memory-efficient resizing
-            max_width = 400
-            width, height = img.size
-            if width > max_width:
-                img.thumbnail((max_width, max_width * 10), Image.LANCZOS)  # maintain aspect ratio
-                logger.info(f"Image resized to: {img.size}")
-            img = img.convert('RGB')
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='JPEG', quality=70)
-            img_byte_arr = img_byte_arr.getvalue()
-            logger.info("Image converted to JPEG format")
-            # Use the provided API key if present, else default
-            if api_key:
-                genai.configure(api_key=api_key)
+
+    def analyze_one(item):
+        index, img_byte_arr, cache_key = item
+        with admission.slot(client):
+            summary = analyze_image_bytes(img_byte_arr, api_key, cache_key)
+        finish(index, summary)
+
+    def analyze_batch(batch):
+        with admission.slot(client):
+            results = analyze_image_batch([(img_byte_arr, cache_key) for _, img_byte_arr, cache_key in batch], api_key)
+        for (index, _, _), summary in zip(batch, results):
+            finish(index, summary)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analyze') as executor:
+        def analyze_pending(pending):
+            if batch_bytes:
+                batches = pack_batches(pending, batch_bytes)
+                logger.info(f"Sending {len(pending)} uncached images in {len(batches)} batches")
+                list(executor.map(metrics.propagate(analyze_batch), batches))
             else:
-                genai.configure(api_key=DEFAULT_GEMINI_API_KEY)
-            model = genai.GenerativeModel('gemini-1.5-flash', safety_settings=safety_settings)
-            prompt = "Analyze this image. Describe the primary subjects, the setting, and any actions taking place. Focus on objective details relevant for storytelling."
-            image_data = base64.b64encode(img_byte_arr).decode()
-            logger.info("Preparing Gemini API request:")
-            logger.info(f"Model: gemini-1.5-flash")
-            logger.info(f"Prompt: {prompt}")
-            logger.info(f"Image data length: {len(image_data)} characters")
-            logger.info(f"Safety settings: {safety_settings}")
-            logger.info("Sending image to Gemini API for analysis...")
-            try:
-                request_content = [
-                    prompt,
-                    {"mime_type": "image/jpeg", "data": image_data}
-                ]
-                import time
-                start_time = time.time()
-                logger.info("Starting API call...")
-                response = model.generate_content(request_content)
-                elapsed_time = time.time() - start_time
-                logger.info(f"API call completed in {elapsed_time:.2f} seconds")
-                logger.info("Successfully received response from Gemini API")
-                logger.info("Gemini API Response Details:")
-                logger.info(f"Response type: {type(response)}")
-                if response.prompt_feedback:
-                    logger.info("Prompt Feedback:")
-                    logger.info(f"Block reason: {response.prompt_feedback.block_reason}")
-                    logger.info(f"Safety ratings: {response.prompt_feedback.safety_ratings}")
-                if response.candidates:
-                    logger.info(f"Number of candidates: {len(response.candidates)}")
-                    for i, candidate in enumerate(response.candidates):
-                        logger.info(f"\nCandidate {i+1}:")
-                        logger.info(f"Finish reason: {candidate.finish_reason}")
-                        logger.info(f"Safety ratings: {candidate.safety_ratings}")
-                        if hasattr(candidate, 'token_count'):
-                            if isinstance(candidate.token_count, dict):
-                                token_info = f"Token usage - Prompt: {candidate.token_count.get('prompt', 'N/A')}, " \
-                                           f"Candidates: {candidate.token_count.get('candidates', 'N/A')}, " \
-                                           f"Total: {candidate.token_count.get('total', 'N/A')}"
-                            else:
-                                token_info = f"Token usage - Total: {candidate.token_count}"
-                            logger.info(token_info)
-                if response.text:
-                    logger.info("\nComplete Response Text:")
-                    logger.info(response.text)
-                    return response.text
+                list(executor.map(metrics.propagate(analyze_one), pending))
+
+        prepared = list(executor.map(metrics.propagate(prepare), enumerate(images)))
+
+        clusters = {}  # representative index -> [(index, prepared image)] of its duplicates, in order
+        if dedup_threshold >= 0:
+            hashed = [index for index, item in enumerate(prepared) if item is not None]
+            for members in cluster_near_duplicates([prepared[index]['phash'] for index in hashed], dedup_threshold):
+                representative = hashed[members[0]]
+                clusters[representative] = [(hashed[member], prepared[hashed[member]]) for member in members[1:]]
+                for member in members[1:]:
+                    index = hashed[member]
+                    images[index]['duplicate_of'] = representative
+                    prepared[index] = None
+            duplicates = sum(1 for image in images if 'duplicate_of' in image)
+            if duplicates:
+                logger.info(f"Skipping analysis of {duplicates} near-duplicate images")
+
+        pending = []
+        for index, item in enumerate(prepared):
+            if item is None:
+                if 'duplicate_of' not in images[index]:
+                    finish(index, None)
+            elif item['summary'] is not None:
+                finish(index, item['summary'])
+            else:
+                pending.append((index, item['api_bytes'], item['cache_key']))
+        analyze_pending(pending)
+
+        # A representative that failed hands its cluster to the next duplicate, until one succeeds
+        while clusters:
+            pending = []
+            promoted = {}
+            for representative, members in clusters.items():
+                if summaries[representative] is not None or not members:
+                    continue
+                (index, item), rest = members[0], members[1:]
+                del images[index]['duplicate_of']
+                for member, _ in rest:
+                    images[member]['duplicate_of'] = index
+                promoted[index] = rest
+                logger.info(f"Analyzing near-duplicate image {index} in place of failed image {representative}")
+                if item['summary'] is not None:
+                    finish(index, item['summary'])
                 else:
-                    logger.error("Gemini API returned empty response text")
-                    return None
-            except Exception as api_error:
-                elapsed_time = time.time() - start_time
-                logger.error(f"Gemini API call failed after {elapsed_time:.2f} seconds: {str(api_error)}")
-                logger.error(f"Error type: {type(api_error)}")
-                if hasattr(api_error, 'response'):
-                    logger.error(f"Gemini API error response: {api_error.response}")
-                return None
-    except Exception as e:
-        error_msg = f"Error processing image {image_path}: {str(e)}"
-        logger.error(error_msg)
-        logger.error(f"Error type: {type(e)}")
-        if hasattr(e, 'response'):
-            logger.error(f"Gemini API error response: {e.response}")
+                    pending.append((index, item['api_bytes'], item['cache_key']))
+            if pending:
+                analyze_pending(pending)
+            clusters = promoted
+
+    # Reported last, once no duplicate can be promoted any more
+    if on_progress:
+        for index, image in enumerate(images):
+            if 'duplicate_of' in image:
+                on_progress(index, 'duplicate')
+    return summaries
+
+class StorySegmentParser:
+    """Split story text into [IMAGE N] segments, incrementally as it streams in.
+
+    Text is only parsed a full line at a time, and a segment is complete once
+    the next marker starts (or at close), so feeding a response in chunks
+    yields the same segments as parsing it whole.
+    """
+    marker_pattern = re.compile(r'^\[IMAGE\s*(\d+)\]', re.IGNORECASE)
+
+    def __init__(self):
+        self.pending = ''
+        self.current_marker = None
+        self.current_segment = []
+
+    def feed(self, text):
+        """Consume more text; returns the segments it completed"""
+        self.pending += text
+        *lines, self.pending = self.pending.split('\n')
+        return self._consume(lines)
+
+    def close(self):
+        """Flush buffered text; returns the remaining segments"""
+        segments = self._consume([self.pending])
+        self.pending = ''
+        if self.current_segment and self.current_marker is not None:
+            segments.append({'marker': self.current_marker, 'text': '\n'.join(self.current_segment).strip()})
+            self.current_segment = []
+        return segments
+
+    def _consume(self, lines):
+        segments = []
+        for line in lines:
+            marker_match = self.marker_pattern.match(line.strip())
+            if marker_match:
+                if self.current_segment and self.current_marker is not None:
+                    segments.append({'marker': self.current_marker, 'text': '\n'.join(self.current_segment).strip()})
+                    self.current_segment = []
+                self.current_marker = int(marker_match.group(1))
+            elif line.strip():
+                self.current_segment.append(line)
+        return segments
+
+def segment_to_slide(segment, image_summaries):
+    """Map a parsed [IMAGE N] segment to its slide, or None if the marker is out of range"""
+    idx = segment['marker'] - 1
+    if not 0 <= idx < len(image_summaries):
         return None
+    image_url = image_summaries[idx].get('image_url') or f"/static/temp_images/{idx+1}_{os.path.basename(image_summaries[idx]['filename'])}"
+    return {
+        'image_url': image_url,
+        'story_segment': segment['text']
+    }
 
-def generate_story(image_summaries, user_prompt=None, max_words=100, max_beats=10, api_key=None):
-    """Generate a story using Gemini API based on image summaries, optional user prompt, max words per beat, max number of beats, and optional API key"""
+def emit_slides(segments, image_summaries, on_slide):
+    """Pass the mappable segments to on_slide as slides; returns segments unchanged"""
+    for segment in segments:
+        slide = segment_to_slide(segment, image_summaries)
+        if slide:
+            on_slide(slide)
+    return segments
+
+@metrics.timed('story')
+def generate_story(image_summaries, user_prompt=None, max_words=100, max_beats=10, api_key=None, on_slide=None, overview=None):
+    """Generate a story using Gemini API based on image summaries, optional user prompt, max words per beat, max number of beats, and optional API key.
+
+    With ``on_slide``, the response is streamed and each slide is passed to
+    on_slide as soon as its [IMAGE N] segment is complete. ``overview`` adds
+    context about images not in image_summaries (see generate_story_hierarchical).
+    """
     try:
-        logger.info("Starting story generation")
+        start_time = time.time()
         # Convert max_words and max_beats to integers, using defaults if None
         max_words = int(max_words) if max_words is not None else 100
         max_beats = int(max_beats) if max_beats is not None else 10
         
         # Use the provided API key if present, else default
-        if api_key:
-            genai.configure(api_key=api_key)
-        else:
-            genai.configure(api_key=DEFAULT_GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-1.5-flash', safety_settings=safety_settings)
+        model = model_pool.get_model(STORY_MODEL, api_key, safety_settings)
         
         # Create a formatted list of image summaries
         image_list = "\n".join([f"Image {i+1}: {summary['summary']}" for i, summary in enumerate(image_summaries)])
@@ -166,6 +446,8 @@ def generate_story(image_summaries, user_prompt=None, max_words=100, max_beats=1
             prompt = f"""You are given {len(image_summaries)} images and their descriptions. Your task is to craft a compelling story using a selection of these images. You may reorder, omit, or select the images that best fit the narrative flow. You do not need to use every image. Aim for a story with no more than {max_beats} concise beats, each under {max_words} words.\n"""
             if user_prompt:
                 prompt += f"\nThe user has requested the following guidance for the story: {user_prompt}\n"
+            if overview:
+                prompt += f"\nThese images were chosen from a larger set of photos. Here is an overview of the full set, section by section:\n{overview}\n"
             prompt += f"""
 For each selected image, write a story segment that:
 1. Describes what's happening in that moment
@@ -185,6 +467,8 @@ Here are the image descriptions:
             prompt = f"""Given these {len(image_summaries)} images and their descriptions, create a compelling story where each image represents a key moment in the narrative.\n"""
             if user_prompt:
                 prompt += f"\nThe user has requested the following guidance for the story: {user_prompt}\n"
+            if overview:
+                prompt += f"\nThese images were chosen from a larger set of photos. Here is an overview of the full set, section by section:\n{overview}\n"
             prompt += f"""
 For each image, write a story segment that:
 1. Describes what's happening in that moment
@@ -204,65 +488,62 @@ And so on for each image.
 Here are the image descriptions:
 """ + image_list
         
-        logger.info("Sending prompt to Gemini API for story generation")
-        response = model.generate_content(prompt)
-        
-        # Log token usage
-        if hasattr(response, 'candidates') and response.candidates:
-            candidate = response.candidates[0]
-            if hasattr(candidate, 'token_count'):
-                if isinstance(candidate.token_count, dict):
-                    token_info = f"Token usage - Prompt: {candidate.token_count.get('prompt', 'N/A')}, " \
-                               f"Candidates: {candidate.token_count.get('candidates', 'N/A')}, " \
-                               f"Total: {candidate.token_count.get('total', 'N/A')}"
-                else:
-                    token_info = f"Token usage - Total: {candidate.token_count}"
-                logger.info(token_info)
+        streamed_segments = None
+        first_slide_ms = None
+        if on_slide:
+            # Stream the response and hand each slide over as soon as its segment is complete
+            response = call_scheduler.call(api_key, model.generate_content, prompt, stream=True)
+            parser = StorySegmentParser()
+            streamed_segments = []
+            for chunk in response:
+                try:
+                    chunk_text = chunk.text
+                except ValueError:
+                    # Chunks without text parts (e.g. safety metadata only)
+                    continue
+                streamed_segments.extend(emit_slides(parser.feed(chunk_text), image_summaries, on_slide))
+                if first_slide_ms is None and streamed_segments:
+                    first_slide_ms = round((time.time() - start_time) * 1000, 1)
+            streamed_segments.extend(emit_slides(parser.close(), image_summaries, on_slide))
+        else:
+            response = call_scheduler.call(api_key, model.generate_content, prompt)
         
         # Check for errors in the response
-        if response.prompt_feedback:
-            logger.info(f"Prompt feedback: {response.prompt_feedback}")
-            if response.prompt_feedback.block_reason:
-                logger.error(f"Gemini API blocked the story generation: {response.prompt_feedback.block_reason}")
-                return None
-            
-        if response.candidates and response.candidates[0].finish_reason:
-            logger.info(f"Gemini API story generation finish reason: {response.candidates[0].finish_reason}")
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            record_gemini_call('story', 'blocked', response)
+            logger.error(f"Gemini API blocked the story generation: {response.prompt_feedback.block_reason}")
+            return None
         
         # Parse the story into segments
         if response.text:
-            logger.info("Full Gemini API story response text:\n" + response.text)
-            
             # Split the story into segments based on [IMAGE X] markers
-            segments = []
-            current_segment = []
-            current_marker = None
-            marker_pattern = re.compile(r'^\[IMAGE\s*(\d+)\]', re.IGNORECASE)
-            for line in response.text.split('\n'):
-                marker_match = marker_pattern.match(line.strip())
-                if marker_match:
-                    if current_segment and current_marker is not None:
-                        segments.append({'marker': current_marker, 'text': '\n'.join(current_segment).strip()})
-                        current_segment = []
-                    current_marker = int(marker_match.group(1))
-                elif line.strip():
-                    current_segment.append(line)
-            if current_segment and current_marker is not None:
-                segments.append({'marker': current_marker, 'text': '\n'.join(current_segment).strip()})
+            if streamed_segments is not None:
+                segments = streamed_segments
+            else:
+                parser = StorySegmentParser()
+                segments = parser.feed(response.text) + parser.close()
             
-            logger.info(f"Parsed story segments and markers: {segments}")
+            record_gemini_call('story', 'ok', response)
+            log_event(logger, 'story_generated',
+                      model=STORY_MODEL,
+                      images=len(image_summaries),
+                      prompt_chars=len(prompt),
+                      streamed=on_slide is not None,
+                      first_slide_ms=first_slide_ms,
+                      elapsed_ms=round((time.time() - start_time) * 1000, 1),
+                      finish_reason=str(response.candidates[0].finish_reason) if response.candidates else None,
+                      tokens=response_token_count(response),
+                      response_chars=len(response.text),
+                      segments=len(segments),
+                      response=response.text)
             
             # If markers are present, use them to map to images
             if segments and all('marker' in seg for seg in segments):
                 image_slides = []
                 for seg in segments:
-                    idx = seg['marker'] - 1
-                    if 0 <= idx < len(image_summaries):
-                        image_url = f"/static/temp_images/{idx+1}_{os.path.basename(image_summaries[idx]['filename'])}"
-                        image_slides.append({
-                            'image_url': image_url,
-                            'story_segment': seg['text']
-                        })
+                    slide = segment_to_slide(seg, image_summaries)
+                    if slide:
+                        image_slides.append(slide)
                     else:
                         logger.warning(f"[IMAGE {seg['marker']}] marker out of range for available images.")
                 if len(image_slides) != len(segments):
@@ -285,7 +566,7 @@ Here are the image descriptions:
                 image_slides = []
                 for i, segment in enumerate(segments_text):
                     if i < len(image_summaries):
-                        image_url = f"/static/temp_images/{i+1}_{os.path.basename(image_summaries[i]['filename'])}"
+                        image_url = image_summaries[i].get('image_url') or f"/static/temp_images/{i+1}_{os.path.basename(image_summaries[i]['filename'])}"
                         image_slides.append({
                             'image_url': image_url,
                             'story_segment': segment
@@ -294,208 +575,594 @@ Here are the image descriptions:
                     logger.warning(f"Number of mapped slides ({len(image_slides)}) doesn't match number of story segments ({len(segments_text)})")
                 return image_slides
         else:
+            record_gemini_call('story', 'empty', response)
             logger.error("Gemini API returned empty response text")
             return None
             
     except Exception as e:
-        logger.error(f"Error generating story: {str(e)}")
-        if hasattr(e, 'response'):
-            logger.error(f"Gemini API error response: {e.response}")
+        record_gemini_call('story', 'error')
+        log_event(logger, 'story_failed', logging.ERROR,
+                  model=STORY_MODEL,
+                  images=len(image_summaries),
+                  error_type=type(e).__name__,
+                  error=str(e))
         return None
 
+@metrics.timed('story_digest')
+def digest_story_chunk(chunk, total, candidates, user_prompt=None, api_key=None):
+    """Condense one chunk of (image_number, summary) pairs into a digest and candidate beats.
+
+    Image numbers are positions in the full upload, so candidates map back to
+    the original images. Falls back to evenly spaced candidates if the
+    response cannot be used.
+    """
+    numbers = [number for number, _ in chunk]
+    digest = None
+    chosen = []
+    try:
+        model = model_pool.get_model(STORY_MODEL, api_key, safety_settings)
+        prompt = f"""You are helping plan a story told through a large set of {total} photos. Below are descriptions of photos {numbers[0]} to {numbers[-1]}.
+
+1. Summarize what happens in this section of photos in no more than three sentences.
+2. Choose up to {candidates} photos from this section that would make the strongest story beats.
+"""
+        if user_prompt:
+            prompt += f"\nThe user has requested the following guidance for the story: {user_prompt}\n"
+        prompt += """
+Respond with only a JSON object like {"digest": "...", "beats": [3, 7]}, where beats lists the chosen photo numbers.
+
+Here are the image descriptions:
+""" + "\n".join(f"Image {number}: {summary['summary']}" for number, summary in chunk)
+        response = call_scheduler.call(api_key, model.generate_content, prompt)
+        data = extract_json_object(response.text) or {}
+        record_gemini_call('story_digest', 'ok' if data else 'unparsed', response)
+        if isinstance(data.get('digest'), str):
+            digest = data['digest'].strip()
+        for number in data.get('beats') or []:
+            if isinstance(number, int) and number in numbers and number not in chosen:
+                chosen.append(number)
+    except Exception as e:
+        record_gemini_call('story_digest', 'error')
+        logger.error(f"Error digesting images {numbers[0]}-{numbers[-1]}: {str(e)}")
+    if not chosen:
+        count = min(candidates, len(numbers))
+        chosen = [numbers[i * len(numbers) // count] for i in range(count)]
+    return {
+        'first': numbers[0],
+        'last': numbers[-1],
+        'digest': digest or ' '.join(summary['summary'][:200] for _, summary in chunk[:3]),
+        'beats': sorted(chosen[:candidates])
+    }
+
+def generate_story_hierarchical(image_summaries, user_prompt=None, max_words=100, max_beats=10, api_key=None,
+                                on_slide=None, chunk_size=25, max_workers=8):
+    """Map-reduce story generation for large uploads.
+
+    Summaries are split into chunks in upload order and each chunk is
+    condensed in parallel into a short digest plus a few candidate beats.
+    A single generate_story pass then writes the story over just the
+    candidates, with the digests as context. Each candidate keeps its own
+    image_url, so the final [IMAGE N] markers map back to the original images.
+    """
+    max_beats = int(max_beats) if max_beats is not None else 10
+    chunks = [
+        list(enumerate(image_summaries, 1))[start:start + chunk_size]
+        for start in range(0, len(image_summaries), chunk_size)
+    ]
+    candidates = max(1, -(-2 * max_beats // len(chunks)))  # Twice max_beats overall, for the final pass to choose from
+    logger.info(f"Digesting {len(image_summaries)} image summaries in {len(chunks)} chunks")
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks))), thread_name_prefix='digest') as executor:
+        digests = list(executor.map(
+            metrics.propagate(lambda chunk: digest_story_chunk(chunk, len(image_summaries), candidates, user_prompt, api_key)),
+            chunks
+        ))
+    selected = [image_summaries[number - 1] for digest in digests for number in digest['beats']]
+    overview = "\n".join(f"Photos {digest['first']}-{digest['last']}: {digest['digest']}" for digest in digests)
+    logger.info(f"Writing story from {len(selected)} candidate beats")
+    return generate_story(selected, user_prompt, max_words, max_beats, api_key, on_slide=on_slide, overview=overview)
+
 def generate_short_uuid():
     """Generate a short UUID (8 characters) for story IDs"""
     return str(uuid.uuid4())[:8]
 
-# Global cleanup manager
-class CleanupManager:
-    def __init__(self):
-        self.cleanup_queue = []  # Priority queue of (timestamp, story_id)
-        self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self._cleanup_worker, daemon=True)
-        self.thread.start()
-        logger.info("Cleanup manager initialized")
-
-    def schedule_cleanup(self, story_id):
-        """Schedule a story for cleanup in 4 hours"""
-        cleanup_time = time.time() + (4 * 60 * 60)  # 4 hours from now
-        with self.lock:
-            heapq.heappush(self.cleanup_queue, (cleanup_time, story_id))
-            logger.info(f"Scheduled cleanup for story {story_id} at {datetime.fromtimestamp(cleanup_time)}")
-
-    def _cleanup_worker(self):
-        """Background worker that handles all cleanup operations"""
-        while True:
-            try:
-                current_time = time.time()
-                
-                with self.lock:
-                    # Check if there are any stories to clean up
-                    while self.cleanup_queue and self.cleanup_queue[0][0] <= current_time:
-                        _, story_id = heapq.heappop(self.cleanup_queue)
-                        story_dir = os.path.join(current_app.static_folder, 'stories', story_id)
-                        
-                        if os.path.exists(story_dir):
-                            try:
-                                shutil.rmtree(story_dir)
-                                logger.info(f"Cleaned up story {story_id}")
-                            except Exception as e:
-                                logger.error(f"Error cleaning up story {story_id}: {str(e)}")
-                
-                # Sleep for a short time before next check
-                time.sleep(60)  # Check every minute
-                
-            except Exception as e:
-                logger.error(f"Error in cleanup worker: {str(e)}")
-                time.sleep(60)  # Wait before retrying
-
-# Initialize the cleanup manager
-cleanup_manager = CleanupManager()
-
 @main.route('/')
 def index():
     return render_template('index.html')
 
-@main.route('/upload', methods=['POST'])
-@limiter.limit('10 per day')
-def upload_file():
-    if 'files[]' not in request.files:
-        return jsonify({'error': 'No files provided'}), 400
-    
-    files = request.files.getlist('files[]')
-    if not files or files[0].filename == '':
-        return jsonify({'error': 'No files selected'}), 400
+def write_story(job, app, image_summaries, params):
+    """Write the story for a job, map-reduce for large sets; slides stream to the job's events"""
+    on_slide = None
+    if app.config.get('STREAM_STORY', True):
+        on_slide = lambda slide: job_tracker.emit(job, 'slide', slide)
+    map_reduce_threshold = app.config.get('STORY_MAP_REDUCE_THRESHOLD', 0)
+    if map_reduce_threshold and len(image_summaries) > map_reduce_threshold:
+        return generate_story_hierarchical(
+            image_summaries,
+            params['story_prompt'],
+            params['max_words'],
+            params['max_beats'],
+            params['api_key'],
+            on_slide=on_slide,
+            chunk_size=app.config.get('STORY_CHUNK_SIZE', 25),
+            max_workers=app.config.get('ANALYSIS_MAX_WORKERS', 8)
+        )
+    return generate_story(
+        image_summaries,
+        params['story_prompt'],
+        params['max_words'],
+        params['max_beats'],
+        params['api_key'],
+        on_slide=on_slide
+    )
 
-    # Generate unique story ID
-    story_id = generate_short_uuid()
-    story_dir = os.path.join(current_app.static_folder, 'stories', story_id)
-    temp_dir = os.path.join(story_dir, 'temp_images')
-    
-    # Create directories
-    os.makedirs(story_dir, exist_ok=True)
-    os.makedirs(temp_dir, exist_ok=True)
+def run_story_job(job, app, uploads, params):
+    """Background half of /upload: extract, analyze, generate and save the story"""
+    with app.app_context(), metrics.span('job', story_id=job.story_id, uploads=len(uploads)):
+        story_id = job.story_id
+        story_dir = job.story_dir
 
-    image_summaries = []
-    image_slides = []
-    
-    try:
-        for file in files:
-            filename = secure_filename(file.filename)
-            ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-            
-            if ext == 'zip':
-                # Process zip file
-                zip_path = os.path.join(temp_dir, filename)
-                file.save(zip_path)
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
-                os.remove(zip_path)
-                
-                for i, image_file in enumerate(sorted(os.listdir(temp_dir))):
-                    if image_file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                        image_path = os.path.join(temp_dir, image_file)
-                        static_image_name = f"{i+1}_{os.path.basename(image_file)}"
-                        static_image_path = os.path.join(temp_dir, static_image_name)
-                        copyfile(image_path, static_image_path)
-                        image_url = f"/static/stories/{story_id}/temp_images/{static_image_name}"
-                        summary = process_image(static_image_path, request.form.get('api_key'))
-                        if summary:
-                            image_summaries.append({
-                                'filename': image_file,
-                                'summary': summary
-                            })
-                            image_slides.append({
-                                'image_url': image_url,
-                                'story_segment': summary
-                            })
-                            logger.info(f"Successfully processed image {image_file}")
-                        else:
-                            logger.warning(f"Failed to process image {image_file}")
-                        os.remove(image_path)
-            
-            elif ext in ('jpg', 'jpeg') and (filename.endswith('.jpg') or filename.endswith('.jpeg')):
-                static_image_name = f"{len(image_summaries)+1}_{filename}"
-                static_image_path = os.path.join(temp_dir, static_image_name)
-                file.save(static_image_path)
-                image_url = f"/static/stories/{story_id}/temp_images/{static_image_name}"
-                summary = process_image(static_image_path, request.form.get('api_key'))
-                if summary:
-                    image_summaries.append({
-                        'filename': filename,
-                        'summary': summary
-                    })
-                    image_slides.append({
-                        'image_url': image_url,
-                        'story_segment': summary
-                    })
-                    logger.info(f"Successfully processed image {filename}")
-                else:
-                    logger.warning(f"Failed to process image {filename}")
+        # Archives are unpacked here rather than in the request, which only saved the uploads
+        if any(upload['filename'].lower().endswith('.zip') for upload in uploads):
+            job_tracker.set_status(job, 'extracting')
+        try:
+            images = place_uploads(
+                uploads,
+                os.path.join(story_dir, 'temp_images'),
+                story_id,
+                max_members=app.config['ZIP_MAX_MEMBERS'],
+                max_total_size=app.config['ZIP_MAX_UNCOMPRESSED_SIZE'],
+                max_member_size=app.config['ZIP_MAX_MEMBER_SIZE']
+            )
+        except (UnsafeArchiveError, zipfile.BadZipFile) as e:
+            logger.warning(f"Rejected upload archive: {str(e)}")
+            job_tracker.fail(job, str(e))
+            return
+        finally:
+            shutil.rmtree(os.path.join(story_dir, 'uploads'), ignore_errors=True)
+        if not images:
+            job_tracker.fail(job, 'No valid images found')
+            return
+
+        job_tracker.set_images(job, [image['filename'] for image in images])
+        for image in images:
+            stem = os.path.splitext(os.path.basename(image['path']))[0]
+            image['display_path'] = os.path.join(os.path.dirname(image['path']), f"{stem}.display.jpg")
+
+        # Analyze all images concurrently; results come back in upload order
+        job_tracker.set_status(job, 'analyzing')
+        summaries = analyze_images(
+            images,
+            params['api_key'],
+            on_progress=lambda index, stage: job_tracker.image_stage(job, index, stage),
+            client=params['client']
+        )
+
+        image_summaries = []
+        image_slides = []
+        for image, summary in zip(images, summaries):
+            if (summary or 'duplicate_of' in image) and os.path.exists(image['display_path']):
+                # Serve the web-sized derivative; the full-size original is no longer needed
+                os.remove(image['path'])
+                image['display_path'] = os.path.join(os.path.dirname(image['display_path']), fingerprint_file(image['display_path']))
+                image['image_url'] = f"/media/stories/{story_id}/{os.path.basename(image['display_path'])}"
+            if 'duplicate_of' in image:
+                continue
+            if summary:
+                image_summaries.append({
+                    'filename': image['filename'],
+                    'image_url': image['image_url'],
+                    'summary': summary
+                })
+                image_slides.append({
+                    'image_url': image['image_url'],
+                    'story_segment': summary
+                })
+                logger.debug(f"Successfully processed image {image['filename']}")
+            else:
+                logger.warning(f"Failed to process image {image['filename']}")
 
         if not image_summaries:
-            return jsonify({'error': 'No valid images found'}), 400
+            job_tracker.fail(job, 'No valid images found')
+            return
 
         logger.info(f"Successfully processed {len(image_summaries)} images from all uploads")
         
-        # Get and convert form parameters
-        story_prompt = request.form.get('story_prompt')
-        max_words = request.form.get('max_words')
-        max_beats = request.form.get('max_beats')
-        api_key = request.form.get('api_key')
-        
         # Generate story
+        job_tracker.set_status(job, 'generating')
         logger.info("Generating story from image summaries...")
-        story = generate_story(
-            image_summaries,
-            story_prompt,
-            max_words,
-            max_beats,
-            api_key
-        )
+        story = write_story(job, app, image_summaries, params)
         
         if not story:
-            return jsonify({'error': 'Failed to generate story'}), 500
+            job_tracker.fail(job, 'Failed to generate story')
+            return
 
         # Save story data
+        # Keep near-duplicate clusters visible: each analyzed representative with the images folded into it
+        clusters = {}
+        for image in images:
+            if 'duplicate_of' in image and summaries[image['duplicate_of']]:
+                clusters.setdefault(image['duplicate_of'], []).append(image['image_url'])
+
         story_data = {
             'id': story_id,
             'created_at': datetime.now().isoformat(),
             'slides': image_slides,
-            'story': story
+            'story': story,
+            # Kept so the story can be regenerated without analyzing the images again
+            'image_summaries': image_summaries,
+            'params': story_settings(params),
+            'clusters': [
+                {'image_url': images[representative]['image_url'], 'duplicates': duplicates}
+                for representative, duplicates in sorted(clusters.items())
+            ]
         }
         
-        with open(os.path.join(story_dir, 'story.json'), 'w') as f:
-            json.dump(story_data, f)
-
-        # Schedule cleanup for this story
-        cleanup_manager.schedule_cleanup(story_id)
+        story_store.save(story_id, story_data)
 
-        return jsonify({
-            'success': True,
+        job_tracker.finish(job, {
             'story_id': story_id,
-            'story': story,
-            'image_slides': image_slides
+            'story_url': f"/story/{story_id}"
         })
 
+def create_story_dir():
+    """Allocate a story id and its directories; returns (story_id, story_dir, upload_dir)"""
+    story_id = generate_short_uuid()
+    story_dir = os.path.join(current_app.static_folder, 'stories', story_id)
+    upload_dir = os.path.join(story_dir, 'uploads')
+    os.makedirs(os.path.join(story_dir, 'temp_images'), exist_ok=True)
+    os.makedirs(upload_dir, exist_ok=True)
+    # Registered before any work so failed uploads expire too
+    story_index.register(story_id)
+    return story_id, story_dir, upload_dir
+
+def request_client():
+    """Who a request counts against for admission control; the same key as the rate limits"""
+    return get_remote_address()
+
+def rejected_response(error):
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+def story_params(form):
+    """Story settings, API key and client from a request's form or JSON body"""
+    return {
+        'story_prompt': form.get('story_prompt'),
+        'max_words': form.get('max_words'),
+        'max_beats': form.get('max_beats'),
+        'api_key': form.get('api_key'),
+        'client': request_client()
+    }
+
+def story_settings(params):
+    """The parts of story_params worth storing with a story; never the API key"""
+    return {name: params[name] for name in ('story_prompt', 'max_words', 'max_beats')}
+
+def start_story_job(story_id, story_dir, uploads, form):
+    """Queue the background story job for saved uploads and return the 202 response"""
+    if not uploads:
+        shutil.rmtree(story_dir, ignore_errors=True)
+        return jsonify({'error': 'No valid images found'}), 400
+
+    # Admitted before any extraction; archives are weighed by the images they list
+    params = story_params(form)
+    images = sum(count_image_members(upload['path']) if upload['filename'].lower().endswith('.zip') else 1
+                 for upload in uploads)
+    try:
+        ticket = admission.admit(params['client'], images, sum(os.path.getsize(upload['path']) for upload in uploads))
+    except AdmissionRejected as e:
+        shutil.rmtree(story_dir, ignore_errors=True)
+        return rejected_response(e)
+    # The job continues the request's trace on the job executor
+    job_tracker.submit(story_id, story_dir, metrics.propagate(admission.bind(ticket, run_story_job)),
+                       current_app._get_current_object(), uploads, params)
+
+    return jsonify({
+        'success': True,
+        'story_id': story_id,
+        'status_url': url_for('main.job_status', story_id=story_id),
+        'events_url': url_for('main.job_events', story_id=story_id)
+    }), 202
+
+def warm_upload_member(upload_id, name, path, client, api_key=None, dedup_threshold=-1):
+    """Analyze a zip member that finished uploading so the story job later finds it in the cache"""
+    # Decode exactly as the job will (via a display derivative) so the cache keys match
+    display_path = path + '.display.jpg'
+    try:
+        with admission.slot(client):
+            prepared = prepare_image(path, display_path)
+            if prepared['summary'] is None and chunked_uploads.claim_hash(upload_id, name, prepared['phash'], dedup_threshold):
+                # Warm-up spends Gemini calls too, so it stops while the backlog is full
+                admission.check(client, images=1)
+                analyze_image_bytes(prepared['api_bytes'], api_key, prepared['cache_key'])
+    except AdmissionRejected:
+        logger.info(f"Not analyzing {os.path.basename(path)} ahead of upload completion: the server is busy")
+    except Exception as e:
+        logger.warning(f"Could not analyze {os.path.basename(path)} ahead of upload completion: {str(e)}")
+    finally:
+        for leftover in (path, display_path):
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+
+@main.route('/upload', methods=['POST'])
+@limiter.limit('10 per day')
+def upload_file():
+    # Shed load on the request size alone, before the body is read
+    try:
+        admission.check(request_client(), size=request.content_length or 0)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    if 'files[]' not in request.files:
+        return jsonify({'error': 'No files provided'}), 400
+    
+    files = request.files.getlist('files[]')
+    if not files or files[0].filename == '':
+        return jsonify({'error': 'No files selected'}), 400
+
+    story_id, story_dir, upload_dir = create_story_dir()
+
+    # Only copy each spooled upload to the story folder; extraction and analysis run in the background
+    uploads = []
+    try:
+        for file in files:
+            filename = secure_filename(file.filename)
+            ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+            
+            if ext == 'zip' or (ext in ('jpg', 'jpeg') and (filename.endswith('.jpg') or filename.endswith('.jpeg'))):
+                upload_path = os.path.join(upload_dir, f"{len(uploads)+1}_{filename}")
+                file.save(upload_path)
+                uploads.append({'filename': filename, 'path': upload_path})
     except Exception as e:
-        logger.error(f"Error processing files: {str(e)}")
+        logger.error(f"Error saving uploads: {str(e)}")
+        shutil.rmtree(story_dir, ignore_errors=True)
         return jsonify({'error': str(e)}), 500
 
-@main.route('/story/<story_id>')
-def view_story(story_id):
+    return start_story_job(story_id, story_dir, uploads, request.form)
+
+@main.route('/uploads', methods=['POST'])
+@limiter.limit('2000 per day')
+def create_upload():
+    """Open a resumable upload session for one file; stories are counted at /uploads/complete"""
+    data = request.get_json(silent=True) or {}
+    client = None
+    try:
+        if isinstance(data.get('size'), int):
+            admission.check(request_client(), size=data['size'])
+            client = request_client()
+        meta = chunked_uploads.create(data.get('filename'), data.get('size'), data.get('api_key'), client)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify({
+        'upload_id': meta['upload_id'],
+        'offset': 0,
+        'chunk_size': chunked_uploads.chunk_size,
+        'upload_url': url_for('main.upload_chunk', upload_id=meta['upload_id'])
+    }), 201
+
+@main.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Where a client should resume: the number of bytes received so far"""
+    try:
+        meta = chunked_uploads.status(upload_id)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify({'upload_id': upload_id, 'offset': meta['offset'], 'size': meta['size']})
+
+@main.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Append the request body at ?offset=N; X-Chunk-SHA256 is verified when present"""
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'offset is required'}), 400
+    try:
+        new_offset = chunked_uploads.append(upload_id, offset, request.stream, request.headers.get('X-Chunk-SHA256'))
+        meta = chunked_uploads.status(upload_id)
+    except UploadError as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), e.status
+
+    # Analyze zip members that are already complete while the rest is still uploading
+    api_key = chunked_uploads.api_key(upload_id)
+    if (meta['filename'].lower().endswith('.zip') and meta.get('client') and analysis_cache.enabled
+            and current_app.config.get('UPLOAD_WARMUP', True) and (api_key or not meta['own_api_key'])):
+        chunked_uploads.scan(upload_id, functools.partial(
+            warm_upload_member,
+            client=meta['client'],
+            api_key=api_key,
+            dedup_threshold=current_app.config.get('DEDUP_HAMMING_THRESHOLD', -1)
+        ))
+    return jsonify({'upload_id': upload_id, 'offset': new_offset, 'size': meta['size']})
+
+@main.route('/uploads/complete', methods=['POST'])
+@limiter.limit('10 per day')
+def complete_upload():
+    """Turn finished upload sessions into a story job, exactly like /upload"""
+    data = request.get_json(silent=True) or {}
+    upload_ids = data.get('upload_ids') or []
+    if not upload_ids:
+        return jsonify({'error': 'No uploads given'}), 400
+    try:
+        uploads = [chunked_uploads.finish(upload_id) for upload_id in upload_ids]
+    except UploadError as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), e.status
+
+    # Shed load on the upload sizes before anything is moved or extracted
+    try:
+        admission.check(request_client(), size=sum(meta['size'] for meta, _ in uploads))
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    # Hand each received file to the job, which extracts archives in the background
+    story_id, story_dir, upload_dir = create_story_dir()
+    staged = []
+    try:
+        for meta, data_path in uploads:
+            upload_path = os.path.join(upload_dir, f"{len(staged)+1}_{meta['filename']}")
+            shutil.move(data_path, upload_path)
+            staged.append({'filename': meta['filename'], 'path': upload_path})
+    except Exception as e:
+        logger.error(f"Error saving uploads: {str(e)}")
+        shutil.rmtree(story_dir, ignore_errors=True)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        for upload_id in upload_ids:
+            chunked_uploads.discard(upload_id)
+
+    return start_story_job(story_id, story_dir, staged, data)
+
+@main.route('/jobs/<story_id>')
+def job_status(story_id):
     story_dir = os.path.join(current_app.static_folder, 'stories', story_id)
-    story_file = os.path.join(story_dir, 'story.json')
-    
-    if not os.path.exists(story_file):
+    status = job_tracker.get_status(story_id, story_dir)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(status)
+
+@main.route('/jobs/<story_id>/events')
+def job_events(story_id):
+    story_dir = os.path.join(current_app.static_folder, 'stories', story_id)
+    if job_tracker.get_status(story_id, story_dir) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    last_event_id = request.headers.get('Last-Event-ID', default=-1, type=int)
+    return Response(
+        job_tracker.stream(story_id, story_dir, last_event_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@main.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@main.route('/cache/stats')
+def cache_stats():
+    return jsonify(analysis_cache.stats())
+
+def stored_summaries(story_data):
+    """Image summaries of a saved story; older stories only have them as the slides' text"""
+    if story_data.get('image_summaries'):
+        return story_data['image_summaries']
+    return [
+        {
+            'filename': os.path.basename(slide['image_url']),
+            'image_url': slide['image_url'],
+            'summary': slide['story_segment']
+        }
+        for slide in story_data.get('slides', [])
+    ]
+
+def run_regenerate_job(job, app, image_summaries, params):
+    """Background half of /story/<id>/regenerate: one story call over the stored summaries"""
+    with app.app_context(), metrics.span('regenerate', story_id=job.story_id, images=len(image_summaries)):
+        job_tracker.set_status(job, 'generating')
+        story = write_story(job, app, image_summaries, params)
+        if not story:
+            job_tracker.fail(job, 'Failed to generate story')
+            return
+        version = story_store.add_version(job.story_id, {
+            'created_at': datetime.now().isoformat(),
+            'story': story,
+            'image_summaries': image_summaries,
+            'params': story_settings(params)
+        })
+        if version is None:
+            job_tracker.fail(job, 'Story not found')
+            return
+        logger.info(f"Saved version {version} of story {job.story_id}")
+        job_tracker.finish(job, {
+            'story_id': job.story_id,
+            'version': version,
+            'story_url': f"/story/{job.story_id}?v={version}"
+        })
+
+@main.route('/story/<story_id>/regenerate', methods=['POST'])
+@limiter.limit('50 per day')
+def regenerate_story(story_id):
+    """Write a new version of a story from its stored image summaries, without re-analyzing the images"""
+    if secure_filename(story_id) != story_id:
         return jsonify({'error': 'Story not found'}), 404
-        
-    with open(story_file, 'r') as f:
-        story_data = json.load(f)
-    
-    return render_template('story.html', 
-                         story_id=story_id,
-                         slides=story_data['slides'],
-                         story=story_data['story'])
+    entry = story_store.get(story_id)
+    if entry is None:
+        return jsonify({'error': 'Story not found'}), 404
+    image_summaries = stored_summaries(entry['data'])
+    if not image_summaries:
+        return jsonify({'error': 'Story has no image summaries to regenerate from'}), 400
+
+    story_dir = os.path.join(current_app.static_folder, 'stories', story_id)
+    status = job_tracker.get_status(story_id, story_dir)
+    if status is not None and status['status'] not in TERMINAL_STATES:
+        return jsonify({'error': 'This story is already being written'}), 409
+
+    # Unset settings fall back to the ones the current version was written with
+    form = request.get_json(silent=True) or request.form
+    stored = entry['data'].get('params') or {}
+    params = {name: stored.get(name) if value in (None, '') else value for name, value in story_params(form).items()}
+    try:
+        ticket = admission.admit(params['client'])
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    job_tracker.submit(story_id, story_dir, metrics.propagate(admission.bind(ticket, run_regenerate_job)),
+                       current_app._get_current_object(), image_summaries, params)
+
+    return jsonify({
+        'success': True,
+        'story_id': story_id,
+        'status_url': url_for('main.job_status', story_id=story_id),
+        'events_url': url_for('main.job_events', story_id=story_id)
+    }), 202
+
+@main.route('/story/<story_id>')
+def view_story(story_id):
+    version = request.args.get('v', type=int)
+    entry = story_store.get(story_id, version)
+    if entry is None and version is not None:
+        return jsonify({'error': 'Story version not found'}), 404
+    if entry is None:
+        # While the story is still being written, render a live page fed by the job's event stream
+        story_dir = os.path.join(current_app.static_folder, 'stories', story_id)
+        status = job_tracker.get_status(story_id, story_dir)
+        if status is None or status['status'] == 'error':
+            return jsonify({'error': 'Story not found'}), 404
+        return render_template('story.html',
+                             story_id=story_id,
+                             slides=[],
+                             story=[],
+                             events_url=url_for('main.job_events', story_id=story_id))
+
+    page = story_store.page(entry, lambda story_data: render_template('story.html',
+                                                                    story_id=story_id,
+                                                                    slides=story_data['slides'],
+                                                                    story=story_data['story'],
+                                                                    version=story_data.get('version')))
+    response = Response(page, mimetype='text/html')
+    response.set_etag(entry['etag'])
+    response.last_modified = entry['last_modified']
+    response.cache_control.no_cache = True  # Revalidate every view; unchanged stories get a 304
+    return response.make_conditional(request)
+
+@main.route('/assets/<digest>/<path:filename>')
+def asset(digest, filename):
+    directory, _, name = filename.rpartition('/')
+    if directory not in ('css', 'js'):
+        return jsonify({'error': 'Not found'}), 404
+    try:
+        current_digest = static_assets.digest(filename)
+    except OSError:
+        return jsonify({'error': 'Not found'}), 404
+    # An outdated digest still gets the current file, just not cached for good
+    return static_assets.send(directory, name, immutable=(digest == current_digest))
+
+@main.route('/media/stories/<story_id>/<filename>')
+def story_media(story_id, filename):
+    if secure_filename(story_id) != story_id:
+        return jsonify({'error': 'Not found'}), 404
+    return static_assets.send(f"stories/{story_id}/temp_images", filename,
+                              immutable=bool(FINGERPRINTED_IMAGE.search(filename)))
 
 @main.route('/slideshow')
 def slideshow():
@@ -0,0 +1,74 @@
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+import redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'photoyarn:'
+REDIS_SCHEMES = ('redis://', 'rediss://', 'unix://')
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive flock on ``path``, created if missing, to serialize work across processes"""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class SharedState:
+    """State kept in Redis for every worker, with a per-process fallback.
+
+    ``local`` and the Redis-backed object made in ``init_app`` expose the same
+    operations. They run on Redis while it answers; after a Redis error they
+    run on ``local``, and Redis is only tried again ``RETRY_INTERVAL`` seconds
+    later rather than on every call. ``purpose`` names the feature in logs.
+    """
+    RETRY_INTERVAL = 30
+
+    def __init__(self, local, purpose):
+        self.local = local
+        self.purpose = purpose
+        self.shared = None
+        self.down_until = 0
+
+    def init_app(self, app, make_shared):
+        """Connect to REDIS_URL, wrapping the client with ``make_shared(client)``"""
+        redis_url = app.config.get('REDIS_URL') or ''
+        if redis_url.startswith(REDIS_SCHEMES):
+            self.shared = make_shared(redis.Redis.from_url(redis_url, socket_timeout=2))
+        else:
+            logger.info(f"No Redis configured; state for {self.purpose} is kept per process")
+
+    def available(self):
+        """The Redis-backed state, or None if Redis is not configured or failed within RETRY_INTERVAL"""
+        if self.shared is not None and time.monotonic() >= self.down_until:
+            return self.shared
+        return None
+
+    def failed(self, error):
+        if not self.down_until:
+            logger.warning(f"Redis unavailable for {self.purpose}, using local state "
+                           f"and retrying every {self.RETRY_INTERVAL}s: {str(error)}")
+        self.down_until = time.monotonic() + self.RETRY_INTERVAL
+
+    def ok(self):
+        if self.down_until:
+            logger.info(f"Redis is available again for {self.purpose}")
+            self.down_until = 0
+
+    def run(self, operation, *args):
+        """Run an operation on Redis, falling back to local state while Redis is down"""
+        shared = self.available()
+        if shared is not None:
+            try:
+                result = getattr(shared, operation)(*args)
+            except redis.RedisError as e:
+                self.failed(e)
+            else:
+                self.ok()
+                return result
+        return getattr(self.local, operation)(*args)
@@ -6,6 +6,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const startButton = document.getElementById('startButton');
     const processingSpinner = document.getElementById('processingSpinner');
     const patienceMessage = document.getElementById('patienceMessage');
+    const progressStatus = document.getElementById('progressStatus');
     const advancedToggle = document.getElementById('advancedToggle');
     const advancedFields = document.getElementById('advancedFields');
     const advancedIcon = document.getElementById('advancedIcon');
@@ -115,47 +116,167 @@ document.addEventListener('DOMContentLoaded', function() {
         processingSpinner.style.display = 'block';
         patienceMessage.style.display = 'block';
 
-        const formData = new FormData();
-        for (let i = 0; i < files.length; i++) {
-            formData.append('files[]', files[i]);
-        }
-
-        // Add advanced options
+        // Advanced options
+        const options = {};
         const storyPrompt = document.getElementById('storyPrompt').value;
         const maxWords = document.getElementById('maxWords').value;
         const maxBeats = document.getElementById('maxBeats').value;
         const apiKey = document.getElementById('apiKey').value;
 
-        if (storyPrompt) formData.append('story_prompt', storyPrompt);
-        if (maxWords) formData.append('max_words', maxWords);
-        if (maxBeats) formData.append('max_beats', maxBeats);
-        if (apiKey) formData.append('api_key', apiKey);
+        if (storyPrompt) options.story_prompt = storyPrompt;
+        if (maxWords) options.max_words = maxWords;
+        if (maxBeats) options.max_beats = maxBeats;
+        if (apiKey) options.api_key = apiKey;
 
         try {
-            const response = await fetch('/upload', {
+            const totalBytes = [...files].reduce((sum, file) => sum + file.size, 0);
+            let uploadedBytes = 0;
+            const uploadIds = [];
+            for (const file of files) {
+                uploadIds.push(await uploadInChunks(file, apiKey, function(offset) {
+                    const percent = Math.floor(100 * (uploadedBytes + offset) / totalBytes);
+                    progressStatus.textContent = `Uploading... (${percent}%)`;
+                }));
+                uploadedBytes += file.size;
+            }
+
+            const response = await fetch('/uploads/complete', {
                 method: 'POST',
-                body: formData
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ upload_ids: uploadIds, ...options })
             });
 
-            const result = await response.json();
+            // Rate-limit and proxy errors are not JSON
+            const result = await response.json().catch(() => ({}));
 
-            if (result.success) {
-                window.location.href = `/story/${result.story_id}`;
+            if (response.ok && result.success) {
+                followProgress(result);
             } else {
-                alert(result.error || 'An error occurred while processing your files.');
-                processingSpinner.style.display = 'none';
-                patienceMessage.style.display = 'none';
-                startButton.disabled = false;
+                showError(result.error || 'An error occurred while processing your files.');
             }
         } catch (error) {
             console.error('Error:', error);
-            alert('An error occurred while uploading your files.');
-            processingSpinner.style.display = 'none';
-            patienceMessage.style.display = 'none';
-            startButton.disabled = false;
+            showError(error.message || 'An error occurred while uploading your files.');
         }
     });
 
+    async function sha256Hex(blob) {
+        // crypto.subtle only exists on secure origins; the checksum is optional
+        if (!window.crypto || !window.crypto.subtle) return null;
+        const digest = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        return [...new Uint8Array(digest)].map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    // Send one file through the resumable upload API, resuming from the server's offset after failures
+    async function uploadInChunks(file, apiKey, onProgress) {
+        const maxAttempts = 6;
+        const initResponse = await fetch('/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, api_key: apiKey || undefined })
+        });
+        if (!initResponse.ok) {
+            const failure = await initResponse.json().catch(() => ({}));
+            throw new Error(failure.error || (initResponse.status === 429
+                ? 'Too many uploads today; please try again later.'
+                : 'Could not start the upload.'));
+        }
+        const session = await initResponse.json();
+
+        let offset = session.offset;
+        let attempts = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + session.chunk_size);
+            const headers = { 'Content-Type': 'application/octet-stream' };
+            const checksum = await sha256Hex(chunk);
+            if (checksum) headers['X-Chunk-SHA256'] = checksum;
+
+            let response = null;
+            try {
+                response = await fetch(`${session.upload_url}?offset=${offset}`, { method: 'PUT', headers, body: chunk });
+            } catch (error) {
+                // Network failure; fall through to retry
+            }
+            if (response) {
+                const result = await response.json().catch(() => ({}));
+                // 409 means the server has a different offset, e.g. an earlier attempt did land
+                if ((response.ok || response.status === 409) && typeof result.offset === 'number') {
+                    offset = result.offset;
+                    attempts = 0;
+                    onProgress(offset);
+                    continue;
+                }
+                if (response.status < 500 && response.status !== 400) {
+                    throw new Error(result.error || 'The upload was rejected.');
+                }
+            }
+
+            attempts++;
+            if (attempts > maxAttempts) throw new Error('The upload keeps failing; please check your connection.');
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempts));
+            try {
+                const status = await fetch(session.upload_url);
+                if (status.ok) offset = (await status.json()).offset;
+            } catch (error) {
+                // Still offline; the next attempt retries from the last known offset
+            }
+        }
+        return session.upload_id;
+    }
+
+    function showError(message) {
+        alert(message);
+        processingSpinner.style.display = 'none';
+        patienceMessage.style.display = 'none';
+        progressStatus.textContent = '';
+        startButton.disabled = false;
+    }
+
+    // Follow the background job over Server-Sent Events until the story is ready
+    function followProgress(result) {
+        const stageLabels = {
+            queued: 'Waiting to start...',
+            extracting: 'Extracting photos...',
+            analyzing: 'Summarizing images...',
+            generating: 'Generating story...'
+        };
+        let total = 0;
+        let completed = 0;
+        const source = new EventSource(result.events_url);
+
+        source.addEventListener('status', function(e) {
+            const data = JSON.parse(e.data);
+            progressStatus.textContent = stageLabels[data.status] || '';
+        });
+        source.addEventListener('images', function(e) {
+            total = JSON.parse(e.data).filenames.length;
+            completed = 0;
+        });
+        source.addEventListener('image', function(e) {
+            const data = JSON.parse(e.data);
+            if (data.stage === 'done' || data.stage === 'failed' || data.stage === 'duplicate') {
+                completed++;
+                progressStatus.textContent = `Summarizing images... (${completed} of ${total})`;
+            }
+        });
+        // The story page picks up the remaining slides from the same stream
+        source.addEventListener('slide', function() {
+            source.close();
+            window.location.href = `/story/${result.story_id}`;
+        });
+        source.addEventListener('done', function(e) {
+            source.close();
+            window.location.href = JSON.parse(e.data).story_url;
+        });
+        source.addEventListener('error', function(e) {
+            // Server-sent job errors carry data; connection drops are retried by EventSource
+            if (e.data) {
+                source.close();
+                showError(JSON.parse(e.data).error || 'An error occurred while processing your files.');
+            }
+        });
+    }
+
     // Slideshow logic for /slideshow page
     if (window.location.pathname === '/slideshow') {
         const slideImage = document.getElementById('slide-image');
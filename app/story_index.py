@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import logging
+import threading
+from app.jobs import job_tracker, TERMINAL_STATES
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def dir_size(path):
+    """Total size in bytes of the files under path"""
+    total = 0
+    for entry in os.scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += dir_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return total
+
+class StoryIndex:
+    """Durable SQLite index of stories on this host: id, creation, expiry and size.
+
+    Lives in the instance folder (never under static/) and is shared by all
+    worker processes, so expiry survives restarts and does not depend on
+    which worker created a story.
+    """
+    def __init__(self):
+        self.path = None
+        self.stories_root = None
+        self.ttl = 4 * 60 * 60
+
+    def init_app(self, app):
+        self.path = app.config.get('STORY_INDEX_PATH') or os.path.join(app.instance_path, 'stories.sqlite3')
+        self.stories_root = os.path.join(app.static_folder, 'stories')
+        self.ttl = app.config.get('STORY_TTL', self.ttl)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        os.makedirs(self.stories_root, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS stories (
+                story_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0
+            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS stories_expires_at ON stories (expires_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS stories_created_at ON stories (created_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('stories_deleted', 0), ('bytes_reclaimed', 0)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def story_dir(self, story_id):
+        return os.path.join(self.stories_root, story_id)
+
+    def register(self, story_id, created_at=None):
+        """Record a new story so it expires STORY_TTL seconds after creation"""
+        created_at = created_at or time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO stories (story_id, created_at, expires_at, size) VALUES (?, ?, ?, 0)',
+                (story_id, created_at, created_at + self.ttl)
+            )
+
+    def update_size(self, story_id, size=None):
+        if size is None:
+            size = dir_size(self.story_dir(story_id))
+        with self._connect() as conn:
+            conn.execute('UPDATE stories SET size = ? WHERE story_id = ?', (size, story_id))
+
+    def expired(self, now, limit):
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT story_id FROM stories WHERE expires_at <= ? ORDER BY expires_at LIMIT ?',
+                (now, limit)
+            )]
+
+    def oldest(self):
+        """(story_id, size) of every story, oldest first"""
+        with self._connect() as conn:
+            return conn.execute('SELECT story_id, size FROM stories ORDER BY created_at').fetchall()
+
+    def known_ids(self):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute('SELECT story_id FROM stories')}
+
+    def total_size(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COALESCE(SUM(size), 0) FROM stories').fetchone()[0]
+
+    def remove(self, story_ids, bytes_reclaimed):
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM stories WHERE story_id = ?', [(story_id,) for story_id in story_ids])
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'stories_deleted'", (len(story_ids),))
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'bytes_reclaimed'", (bytes_reclaimed,))
+
+    def stats(self):
+        """Stories and bytes indexed, and the sweeper's running totals, for the story index gauge"""
+        if self.path is None:
+            return {}
+        with self._connect() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+            stories, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM stories').fetchone()
+        counters.update({'stories': stories, 'bytes': size})
+        return {(name,): value for name, value in counters.items()}
+
+class StorySweeper:
+    """Deletes expired stories, and the oldest ones when the disk runs full.
+
+    Every worker runs the loop, but only the process holding an exclusive
+    lock on the sweeper lock file sweeps, so there is one sweeper per host;
+    if it dies the lock is released and another worker takes over. Stories
+    are deleted in batches, oldest first once disk usage passes the
+    high-water mark, until it drops below the low-water mark. Only finished
+    stories are evicted, and only when deleting all of them could bring
+    usage under the low-water mark; a disk filled by something else is
+    logged and counted instead of emptied of stories.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.interval = 60
+        self.batch_size = 100
+        self.high_water = 0.90
+        self.low_water = 0.80
+        self.max_total_bytes = 0
+        self.lock_path = None
+        self.lock_file = None
+        self.thread = None
+        self.scratch_dirs = []
+        # A forked worker (e.g. gunicorn --preload) inherits neither the thread nor leadership
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def init_app(self, app):
+        self.interval = app.config.get('STORY_SWEEP_INTERVAL', self.interval)
+        self.batch_size = app.config.get('STORY_SWEEP_BATCH_SIZE', self.batch_size)
+        self.high_water = app.config.get('STORY_DISK_HIGH_WATER', self.high_water)
+        self.low_water = app.config.get('STORY_DISK_LOW_WATER', self.low_water)
+        self.max_total_bytes = app.config.get('STORY_MAX_TOTAL_BYTES', self.max_total_bytes)
+        self.lock_path = os.path.join(os.path.dirname(self.index.path), 'story-sweeper.lock')
+
+    def add_scratch_dir(self, path):
+        """Empty path of files left by earlier runs, in the background, once this process leads"""
+        if path not in self.scratch_dirs:
+            self.scratch_dirs.append(path)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='story-sweeper', daemon=True)
+            self.thread.start()
+
+    def _is_leader(self):
+        if self.lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        logger.info(f"Process {os.getpid()} is the story sweeper for this host")
+        self.clear_scratch_dirs()
+        return True
+
+    def _after_fork(self):
+        self.thread = None
+        if self.lock_file is not None:
+            # The parent still holds the lock through its own descriptor
+            self.lock_file.close()
+            self.lock_file = None
+
+    def clear_scratch_dirs(self):
+        removed = 0
+        for path in self.scratch_dirs:
+            if not os.path.isdir(path):
+                continue
+            for entry in os.scandir(path):
+                try:
+                    if entry.is_file():
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError as e:
+                    logger.warning(f"Could not remove {entry.path}: {str(e)}")
+        if removed:
+            logger.info(f"Removed {removed} leftover files from scratch folders")
+
+    def _run(self):
+        while True:
+            try:
+                if self._is_leader():
+                    self.sweep()
+            except Exception as e:
+                logger.error(f"Error in story sweeper: {str(e)}")
+            time.sleep(self.interval)
+
+    def adopt_orphans(self):
+        """Index story directories the index does not know about, e.g. from before it existed"""
+        known = self.index.known_ids()
+        for entry in os.scandir(self.index.stories_root):
+            if entry.is_dir() and entry.name not in known:
+                self.index.register(entry.name, created_at=entry.stat().st_mtime)
+                self.index.update_size(entry.name)
+
+    def _excess(self, water):
+        """Bytes to free to bring usage under water, 0 if it is already under"""
+        excess = 0
+        if self.max_total_bytes:
+            excess = self.index.total_size() - self.max_total_bytes * water / self.high_water
+        usage = shutil.disk_usage(self.index.stories_root)
+        return max(0, excess, usage.used - usage.total * water)
+
+    def _over(self, water):
+        return self._excess(water) > 0
+
+    def _evictable(self, story_id):
+        """A story may be evicted once it is saved and no live job is writing it"""
+        story_dir = self.index.story_dir(story_id)
+        if not os.path.exists(os.path.join(story_dir, 'story.json')):
+            return False
+        try:
+            with open(os.path.join(story_dir, 'job.json'), 'r') as f:
+                snapshot = json.load(f)
+            return snapshot.get('status') in TERMINAL_STATES or job_tracker.orphaned(snapshot)
+        except FileNotFoundError:
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def _delete(self, story_ids):
+        reclaimed = 0
+        for story_id in story_ids:
+            story_dir = self.index.story_dir(story_id)
+            if os.path.isdir(story_dir):
+                reclaimed += dir_size(story_dir)
+                shutil.rmtree(story_dir, ignore_errors=True)
+        self.index.remove(story_ids, reclaimed)
+        return reclaimed
+
+    def sweep(self):
+        """Run one sweep; returns (stories deleted, bytes reclaimed)"""
+        self.adopt_orphans()
+        deleted = 0
+        reclaimed = 0
+        while True:
+            story_ids = self.index.expired(time.time(), self.batch_size)
+            if not story_ids:
+                break
+            reclaimed += self._delete(story_ids)
+            deleted += len(story_ids)
+        if self._over(self.high_water):
+            needed = self._excess(self.low_water)
+            candidates = [(story_id, size) for story_id, size in self.index.oldest() if self._evictable(story_id)]
+            evictable = sum(size for _, size in candidates)
+            if evictable < needed:
+                logger.warning(f"Story storage above high-water mark, but evicting every finished story would "
+                               f"free only {evictable} of {int(needed)} bytes needed; not evicting")
+                EVICTIONS_SKIPPED.inc()
+            else:
+                logger.warning("Story storage above high-water mark; evicting oldest finished stories")
+                for start in range(0, len(candidates), self.batch_size):
+                    if not self._over(self.low_water):
+                        break
+                    # Recheck: a story may have started regenerating since it was listed
+                    story_ids = [story_id for story_id, _ in candidates[start:start + self.batch_size]
+                                 if self._evictable(story_id)]
+                    reclaimed += self._delete(story_ids)
+                    deleted += len(story_ids)
+        if deleted:
+            logger.info(f"Story sweeper deleted {deleted} stories, reclaiming {reclaimed} bytes")
+        return deleted, reclaimed
+
+story_index = StoryIndex()
+story_sweeper = StorySweeper(story_index)
+
+metrics.gauge('photoyarn_story_index', 'Stories and bytes on this host, and stories deleted and bytes reclaimed by the sweeper',
+              ['stat'], callback=story_index.stats)
+EVICTIONS_SKIPPED = metrics.counter('photoyarn_story_evictions_skipped_total',
+                                    'Sweeps over the high-water mark where evicting finished stories could not free enough space')
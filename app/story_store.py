@@ -0,0 +1,119 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from app.story_index import story_index
+from app.assets import static_assets
+from app.metrics import BYTES_WRITTEN
+from app.shared_state import locked
+
+logger = logging.getLogger(__name__)
+
+class StoryStore:
+    """Reads and writes story.json, with an LRU of parsed stories and rendered pages.
+
+    A cached entry is keyed to story.json's mtime and size, so a single
+    ``stat`` per view detects a story rewritten by another worker or deleted
+    by the sweeper; ``save`` invalidates this process's entry directly. The
+    same stat, together with the asset and template version, gives each page
+    a validator for ETag / Last-Modified, letting repeat views end in a 304.
+
+    ``story.json`` is always the latest version of a story. Regenerating a
+    story archives the previous one as ``story.v<N>.json`` in the same
+    directory, so every version shares the story's image assets.
+    """
+    def __init__(self, index, max_entries=256):
+        self.index = index
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (story_id, version) -> {'etag', 'last_modified', 'data', 'page'}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_entries = app.config.get('STORY_CACHE_MAX_ENTRIES', self.max_entries)
+
+    def story_file(self, story_id, version=None):
+        """Path of the latest story, or of an archived version"""
+        name = 'story.json' if version is None else f'story.v{version}.json'
+        return os.path.join(self.index.story_dir(story_id), name)
+
+    def save(self, story_id, story_data, version=None):
+        """Atomically write story.json (or an archived version) and record the story's new size"""
+        story_file = self.story_file(story_id, version)
+        tmp_file = story_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(story_data, f)
+            BYTES_WRITTEN.inc(f.tell(), kind='story')
+        os.replace(tmp_file, story_file)
+        self.invalidate(story_id, version)
+        self.index.update_size(story_id)
+
+    def add_version(self, story_id, changes):
+        """Archive the latest story and save it with ``changes`` applied as the next version.
+
+        Returns the new version number, or None if the story no longer exists.
+        Serialized across processes, so concurrent regenerations get distinct
+        versions.
+        """
+        with locked(os.path.join(self.index.story_dir(story_id), 'story.lock')):
+            entry = self.get(story_id)
+            if entry is None:
+                return None
+            current = entry['data']
+            version = current.get('version', 1)
+            self.save(story_id, dict(current, version=version), version)
+            self.save(story_id, dict(current, **changes, version=version + 1))
+            return version + 1
+
+    def invalidate(self, story_id, version=None):
+        with self.lock:
+            self.entries.pop((story_id, version), None)
+
+    def get(self, story_id, version=None):
+        """Return the cache entry for a story, loading it on a miss; None if it does not exist.
+
+        ``version`` selects an earlier version; asking for the latest one by
+        number returns the latest entry.
+        """
+        if version is not None:
+            latest = self.get(story_id)
+            if latest is None or latest['data'].get('version', 1) == version:
+                return latest
+        key = (story_id, version)
+        story_file = self.story_file(story_id, version)
+        try:
+            st = os.stat(story_file)
+        except FileNotFoundError:
+            self.invalidate(story_id, version)
+            return None
+        etag = f"{st.st_mtime_ns:x}-{st.st_size:x}-{static_assets.version}"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['etag'] == etag:
+                self.entries.move_to_end(key)
+                return entry
+        try:
+            with open(story_file, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        entry = {
+            'etag': etag,
+            'last_modified': datetime.fromtimestamp(st.st_mtime, timezone.utc),
+            'data': data,
+            'page': None
+        }
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def page(self, entry, render):
+        """Rendered page for a cache entry, calling render(data) the first time"""
+        if entry['page'] is None:
+            entry['page'] = render(entry['data']).encode('utf-8')
+        return entry['page']
+
+story_store = StoryStore(story_index)
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+def log_event(logger, event, level=logging.INFO, sampled=False, **fields):
+    """Log one structured event; ``sampled`` events are subject to LOG_SAMPLE_RATE"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'event': event, 'sampled': sampled, 'fields': fields})
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; string fields longer than ``max_field_length`` are truncated"""
+    def __init__(self, max_field_length=500):
+        super().__init__()
+        self.max_field_length = max_field_length
+
+    def truncate(self, value):
+        if isinstance(value, str) and self.max_field_length and len(value) > self.max_field_length:
+            return value[:self.max_field_length] + f"...[{len(value) - self.max_field_length} more chars]"
+        return value
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None) or 'log',
+            'message': self.truncate(record.getMessage())
+        }
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            entry[key] = self.truncate(value)
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS and key not in ('event', 'sampled', 'fields'):
+                entry[key] = self.truncate(value)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines with structured fields appended as key=value"""
+    def __init__(self, max_field_length=500):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.json_formatter = JsonFormatter(max_field_length)
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None) or {}
+        if fields:
+            line += ' ' + ' '.join(f"{key}={self.json_formatter.truncate(value)}" for key, value in fields.items())
+        return line
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of sampled events below WARNING; everything else passes"""
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1 or record.levelno >= logging.WARNING or not getattr(record, 'sampled', False):
+            return True
+        return random.random() < self.rate
+
+class PreparingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps the record's structured fields instead of flattening them into msg"""
+    def prepare(self, record):
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_listener = None
+
+def _start_listener(log_queue, handler):
+    global _listener
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+def _restart_listener_after_fork():
+    """A forked worker (e.g. gunicorn --preload) inherits the listener but not its thread"""
+    if _listener is None:
+        return
+    # Records queued before the fork are the parent's to write; the child starts with an empty queue
+    log_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            handler.queue = log_queue
+    _start_listener(log_queue, *_listener.handlers)
+
+def configure_logging(app):
+    """Route all logging through a queue to a background writer thread.
+
+    Request and job threads only enqueue records; formatting and file I/O
+    happen on the listener thread. Configured once per process from
+    LOG_LEVEL, LOG_FILE (stderr when unset), LOG_FORMAT ('json' or 'text'),
+    LOG_SAMPLE_RATE and LOG_MAX_FIELD_LENGTH. Forked children restart the
+    listener thread for themselves.
+    """
+    if _listener is not None:
+        return
+    log_file = app.config.get('LOG_FILE')
+    try:
+        handler = logging.handlers.WatchedFileHandler(log_file) if log_file else logging.StreamHandler(sys.stderr)
+    except OSError as e:
+        handler = logging.StreamHandler(sys.stderr)
+        print(f"Warning: Could not open log file {log_file}, logging to stderr: {e}", file=sys.stderr)
+    max_field_length = app.config.get('LOG_MAX_FIELD_LENGTH', 500)
+    if app.config.get('LOG_FORMAT', 'json') == 'json':
+        handler.setFormatter(JsonFormatter(max_field_length))
+    else:
+        handler.setFormatter(TextFormatter(max_field_length))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = PreparingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(app.config.get('LOG_SAMPLE_RATE', 1.0)))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+
+    _start_listener(log_queue, handler)
+    atexit.register(_stop_listener)
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
@@ -0,0 +1,329 @@
+import os
+import re
+import json
+import time
+import uuid
+import zlib
+import zipfile
+import shutil
+import struct
+import hashlib
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import secure_filename
+from app.imaging import cluster_near_duplicates
+from app.ingest import is_image_name, sniff_mime_type, IMAGE_MIME_TYPES, SNIFF_BYTES, COPY_CHUNK_SIZE
+from app.metrics import BYTES_WRITTEN
+from app.shared_state import locked
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+UPLOAD_EXTENSIONS = ('.zip', '.jpg', '.jpeg')
+# signature, version, flags, method, mod time, mod date, crc32, compressed size, size, name length, extra length
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+ZIP64_SIZE = 0xFFFFFFFF
+
+class UploadError(Exception):
+    """A request that does not fit the upload session; carries the HTTP status and current offset"""
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+class ChunkedUploads:
+    """Resumable uploads assembled on local disk one chunk at a time.
+
+    Each session is a directory holding ``meta.json`` and the ``data`` file
+    that chunks are appended to. The data file's length is the session
+    offset, so a client that lost its connection asks for the offset and
+    carries on from there, and any worker process can accept the next chunk;
+    appends are serialized with a file lock. Chunks may carry a SHA-256 that
+    is checked before they are kept.
+
+    While a zip is still arriving, its local file headers are scanned in the
+    background and every image member that is fully on disk is extracted and
+    handed to ``on_member`` one at a time, letting analysis start before the
+    upload completes. Only sessions that passed admission when they were
+    opened (``meta['client']``) are warmed, at most ``warmup_max_members``
+    members each. The scan applies the archive's member, member size and
+    total size limits and stops warming once one is reached. It is only a
+    head start: the finished archive is still extracted through its central
+    directory with all the usual limits.
+    """
+    PURGE_INTERVAL = 60  # Seconds between sweeps for abandoned sessions
+
+    def __init__(self):
+        self.root = None
+        self.max_size = 500 * 1024 * 1024
+        self.chunk_size = 8 * 1024 * 1024
+        self.ttl = 24 * 60 * 60
+        self.max_members = 2000
+        self.max_member_size = 100 * 1024 * 1024
+        self.max_total_size = 1024 * 1024 * 1024
+        self.warmup_workers = 2
+        self.warmup_max_members = 200
+        self.executor = None
+        self.purged_at = 0
+        self.lock = threading.Lock()
+        self.api_keys = {}  # upload_id -> API key, kept in memory only
+        self.warm_hashes = {}  # upload_id -> {member name: perceptual hash} seen by warm-up
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # A forked worker has none of the parent's warm-up threads; it creates its own executor when needed
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.root = app.config.get('UPLOAD_SESSION_FOLDER') or os.path.join(app.instance_path, 'uploads')
+        self.max_size = app.config.get('UPLOAD_MAX_SIZE', self.max_size)
+        self.chunk_size = app.config.get('UPLOAD_CHUNK_SIZE', self.chunk_size)
+        self.ttl = app.config.get('UPLOAD_SESSION_TTL', self.ttl)
+        self.max_members = app.config.get('ZIP_MAX_MEMBERS', self.max_members)
+        self.max_member_size = app.config.get('ZIP_MAX_MEMBER_SIZE', self.max_member_size)
+        self.max_total_size = app.config.get('ZIP_MAX_UNCOMPRESSED_SIZE', self.max_total_size)
+        self.warmup_workers = app.config.get('UPLOAD_WARMUP_WORKERS', self.warmup_workers)
+        self.warmup_max_members = app.config.get('UPLOAD_WARMUP_MAX_MEMBERS', self.warmup_max_members)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _session_dir(self, upload_id):
+        if not UPLOAD_ID.match(upload_id or ''):
+            raise UploadError('Upload not found', 404)
+        session_dir = os.path.join(self.root, upload_id)
+        if not os.path.isdir(session_dir):
+            raise UploadError('Upload not found', 404)
+        return session_dir
+
+    def create(self, filename, size, api_key=None, client=None):
+        """Open a session for one file of ``size`` bytes; ``client`` is set once it passed admission"""
+        filename = secure_filename(filename or '')
+        if not filename.lower().endswith(UPLOAD_EXTENSIONS):
+            raise UploadError('Only .zip and .jpg files can be uploaded')
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('Upload size must be a positive number of bytes')
+        if size > self.max_size:
+            raise UploadError(f"Upload is {size} bytes; the limit is {self.max_size}", 413)
+        # One session is opened per file, so keep this cheap and only sweep now and then
+        if time.time() - self.purged_at >= self.PURGE_INTERVAL:
+            self.purged_at = time.time()
+            self.purge_expired()
+        upload_id = uuid.uuid4().hex
+        session_dir = os.path.join(self.root, upload_id)
+        os.makedirs(session_dir)
+        meta = {
+            'upload_id': upload_id,
+            'filename': filename,
+            'size': size,
+            'created_at': time.time(),
+            'own_api_key': bool(api_key),
+            'client': client
+        }
+        with open(os.path.join(session_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        open(os.path.join(session_dir, 'data'), 'wb').close()
+        if api_key:
+            with self.lock:
+                self.api_keys[upload_id] = api_key
+        return meta
+
+    def status(self, upload_id):
+        session_dir = self._session_dir(upload_id)
+        with open(os.path.join(session_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        meta['offset'] = os.path.getsize(os.path.join(session_dir, 'data'))
+        return meta
+
+    def append(self, upload_id, offset, stream, checksum=None):
+        """Append one chunk at ``offset`` and return the new offset"""
+        session_dir = self._session_dir(upload_id)
+        data_path = os.path.join(session_dir, 'data')
+        with locked(os.path.join(session_dir, 'lock')):
+            meta = self.status(upload_id)
+            current = meta['offset']
+            if offset != current:
+                raise UploadError('Chunk offset does not match the upload', 409, current)
+            digest = hashlib.sha256()
+            written = 0
+            with open(data_path, 'ab') as f:
+                try:
+                    while True:
+                        block = stream.read(COPY_CHUNK_SIZE)
+                        if not block:
+                            break
+                        written += len(block)
+                        if written > self.chunk_size or current + written > meta['size']:
+                            raise UploadError('Chunk is larger than allowed', 413, current)
+                        digest.update(block)
+                        f.write(block)
+                    if checksum and checksum.lower() != digest.hexdigest():
+                        raise UploadError('Chunk checksum mismatch', 400, current)
+                except BaseException:
+                    # Drop the partial chunk so the client can resend it from the same offset
+                    f.truncate(current)
+                    raise
+        BYTES_WRITTEN.inc(written, kind='upload')
+        return current + written
+
+    def finish(self, upload_id):
+        """Return (meta, data path) for a fully received upload"""
+        meta = self.status(upload_id)
+        if meta['offset'] != meta['size']:
+            raise UploadError('Upload is incomplete', 409, meta['offset'])
+        return meta, os.path.join(self.root, upload_id, 'data')
+
+    def discard(self, upload_id):
+        with self.lock:
+            self.api_keys.pop(upload_id, None)
+            self.warm_hashes.pop(upload_id, None)
+        if UPLOAD_ID.match(upload_id or ''):
+            shutil.rmtree(os.path.join(self.root, upload_id), ignore_errors=True)
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            try:
+                last_write = os.path.getmtime(os.path.join(entry.path, 'data'))
+            except OSError:
+                last_write = entry.stat().st_mtime
+            if last_write < cutoff:
+                logger.info(f"Removing abandoned upload {entry.name}")
+                self.discard(entry.name)
+        # Sessions completed or purged by another worker leave their warm-up entries behind here
+        with self.lock:
+            known = set(self.api_keys) | set(self.warm_hashes)
+        for upload_id in known:
+            if not os.path.isdir(os.path.join(self.root, upload_id)):
+                with self.lock:
+                    self.api_keys.pop(upload_id, None)
+                    self.warm_hashes.pop(upload_id, None)
+
+    def api_key(self, upload_id):
+        """The key given at init, if this process knows it; None for uploads on the server key"""
+        with self.lock:
+            return self.api_keys.get(upload_id)
+
+    def claim_hash(self, upload_id, name, phash, threshold):
+        """Record a member's phash for warm-up; False if it is a near-duplicate that will not be analyzed.
+
+        Clusters are formed the way the story job forms them, greedily in
+        member name order, over the members seen so far.
+        """
+        with self.lock:
+            hashes = self.warm_hashes.setdefault(upload_id, {})
+            hashes[name] = phash
+            if threshold < 0:
+                return True
+            names = sorted(hashes)
+            clusters = cluster_near_duplicates([hashes[member] for member in names], threshold)
+            return any(names[cluster[0]] == name for cluster in clusters)
+
+    def scan(self, upload_id, on_member):
+        """Extract newly completed zip members in the background, calling on_member(upload_id, name, path)"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.warmup_workers, thread_name_prefix='upload-warmup')
+        self.executor.submit(self._scan, upload_id, on_member)
+
+    def _scan(self, upload_id, on_member):
+        try:
+            session_dir = self._session_dir(upload_id)
+            with locked(os.path.join(session_dir, 'scan.lock')):
+                state_path = os.path.join(session_dir, 'scan.json')
+                try:
+                    with open(state_path, 'r') as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = {'offset': 0, 'members': 0, 'total': 0, 'done': False}
+                if state['done']:
+                    return
+                try:
+                    # Each member is handed over as soon as it is extracted, so at most one waits on disk
+                    for name, path in self._scan_members(session_dir, state):
+                        self._save_scan_state(state_path, state)
+                        on_member(upload_id, name, path)
+                finally:
+                    self._save_scan_state(state_path, state)
+        except UploadError:
+            pass  # Completed or discarded meanwhile
+        except Exception as e:
+            logger.warning(f"Could not scan upload {upload_id} ahead of completion: {str(e)}")
+
+    @staticmethod
+    def _save_scan_state(state_path, state):
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+
+    def _scan_members(self, session_dir, state):
+        """Walk local headers from state['offset'] and yield (name, path) of image members fully received.
+
+        ``state`` is advanced before each member is yielded; ``total`` counts
+        the uncompressed bytes written, which stay under max_total_size.
+        """
+        data_path = os.path.join(session_dir, 'data')
+        members_dir = os.path.join(session_dir, 'members')
+        os.makedirs(members_dir, exist_ok=True)
+        available = os.path.getsize(data_path)
+        with open(data_path, 'rb') as f:
+            while state['members'] < min(self.max_members, self.warmup_max_members):
+                if state['offset'] + LOCAL_HEADER.size > available:
+                    break
+                f.seek(state['offset'])
+                (signature, _, flags, method, _, _, _, compressed_size, size,
+                 name_length, extra_length) = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+                # Central directory reached, or sizes only known after the data: leave it to completion
+                if (signature != LOCAL_HEADER_SIGNATURE or flags & FLAG_DATA_DESCRIPTOR
+                        or ZIP64_SIZE in (compressed_size, size)):
+                    state['done'] = True
+                    break
+                data_start = state['offset'] + LOCAL_HEADER.size + name_length + extra_length
+                if data_start + compressed_size > available:
+                    break
+                name = f.read(name_length).decode('utf-8', 'replace')
+                state['offset'] = data_start + compressed_size
+                if (flags & FLAG_ENCRYPTED or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+                        or size > self.max_member_size or not is_image_name(name)):
+                    continue
+                if state['total'] + size > self.max_total_size:
+                    logger.info(f"Stopped warming upload at {state['total']} uncompressed bytes; the limit is {self.max_total_size}")
+                    state['done'] = True
+                    break
+                f.seek(data_start)
+                state['members'] += 1
+                state['total'] += size
+                path = os.path.join(members_dir, f"{state['members']}_{secure_filename(posixpath.basename(name))}")
+                if self._extract_member(f, compressed_size, size, method, path):
+                    yield name, path
+
+    def _extract_member(self, f, compressed_size, size, method, path):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == zipfile.ZIP_DEFLATED else None
+        remaining = compressed_size
+        written = 0
+        head = b''
+        with open(path, 'wb') as out:
+            while remaining:
+                block = f.read(min(COPY_CHUNK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                if decompressor is not None:
+                    block = decompressor.decompress(block, size + 1 - written)
+                written += len(block)
+                if written > size:
+                    break
+                if len(head) < SNIFF_BYTES:
+                    head += block[:SNIFF_BYTES - len(head)]
+                out.write(block)
+        if written != size or sniff_mime_type(head) not in IMAGE_MIME_TYPES:
+            os.remove(path)
+            return False
+        return True
+
+chunked_uploads = ChunkedUploads()
@@ -0,0 +1,110 @@
+"""Local stand-in for google-generativeai models.
+
+Enable with ``GEMINI_BACKEND=bench.fake_gemini:FakeGenerativeModel``. Each
+call sleeps for a configurable latency, fails at a configurable rate with
+the same exceptions the Gemini SDK raises, and answers each of the app's
+prompts with canned output in the expected shape: a description per image,
+per-image JSON for batches, digest JSON for map-reduce chunks and
+``[IMAGE N]`` segments for stories. Settings are read from the environment:
+
+    FAKE_GEMINI_LATENCY         mean seconds per call (default 0.5)
+    FAKE_GEMINI_JITTER          +/- fraction of the latency (default 0.25)
+    FAKE_GEMINI_ERROR_RATE      fraction of calls raising ServiceUnavailable (default 0)
+    FAKE_GEMINI_THROTTLE_RATE   fraction of calls raising ResourceExhausted (default 0)
+    FAKE_GEMINI_STREAM_CHUNKS   chunks a streamed response is split into (default 8)
+"""
+import os
+import re
+import json
+import time
+import random
+import hashlib
+from google.api_core import exceptions as api_exceptions
+
+IMAGE_LINE = re.compile(r'^Image (\d+):', re.MULTILINE)
+MAX_BEATS = re.compile(r'no more than (\d+) concise beats')
+
+def _setting(name, default):
+    return float(os.environ.get(name, default))
+
+class FakeCandidate:
+    def __init__(self, token_count):
+        self.finish_reason = 'STOP'
+        self.safety_ratings = []
+        self.token_count = token_count
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.prompt_feedback = None
+        self.candidates = [FakeCandidate(max(1, len(text) // 4))]
+
+class FakeStreamedResponse(FakeResponse):
+    """Iterates over chunks with a delay between them, like a streamed SDK response"""
+    def __init__(self, text, chunks, delay):
+        super().__init__(text)
+        size = max(1, -(-len(text) // chunks))
+        self.chunks = [text[start:start + size] for start in range(0, len(text), size)]
+        self.delay = delay
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            time.sleep(self.delay)
+            yield FakeResponse(chunk)
+
+class FakeGenerativeModel:
+    def __init__(self, model_name, safety_settings=None):
+        self.model_name = model_name
+        self.latency = _setting('FAKE_GEMINI_LATENCY', 0.5)
+        self.jitter = _setting('FAKE_GEMINI_JITTER', 0.25)
+        self.error_rate = _setting('FAKE_GEMINI_ERROR_RATE', 0)
+        self.throttle_rate = _setting('FAKE_GEMINI_THROTTLE_RATE', 0)
+        self.stream_chunks = int(_setting('FAKE_GEMINI_STREAM_CHUNKS', 8))
+
+    def generate_content(self, content, stream=False, **kwargs):
+        parts = [content] if isinstance(content, str) else list(content)
+        prompt = next((part for part in parts if isinstance(part, str)), '')
+        images = [part['data'] for part in parts if isinstance(part, dict)]
+        latency = self.latency * (1 + random.uniform(-self.jitter, self.jitter))
+
+        roll = random.random()
+        if roll < self.throttle_rate:
+            time.sleep(latency / 10)
+            raise api_exceptions.ResourceExhausted('Fake quota exceeded')
+        if roll < self.throttle_rate + self.error_rate:
+            time.sleep(latency)
+            raise api_exceptions.ServiceUnavailable('Fake backend unavailable')
+
+        text = self.respond(prompt, images)
+        if stream:
+            # Spread the latency over the chunks so the first beat arrives early
+            first = latency / 2
+            time.sleep(first)
+            return FakeStreamedResponse(text, self.stream_chunks, (latency - first) / self.stream_chunks)
+        time.sleep(latency)
+        return FakeResponse(text)
+
+    @staticmethod
+    def describe(image_data):
+        scene = int(hashlib.sha256(image_data.encode()).hexdigest()[:6], 16) % 97
+        return f"A photo of scene {scene}: two people walk along a path at dusk while a dog runs ahead."
+
+    def respond(self, prompt, images):
+        if len(images) > 1:
+            return json.dumps({str(position): self.describe(data) for position, data in enumerate(images, 1)})
+        if images:
+            return self.describe(images[0])
+        numbers = [int(number) for number in IMAGE_LINE.findall(prompt)]
+        if '"digest"' in prompt:
+            return json.dumps({
+                'digest': f"Photos {numbers[0]} to {numbers[-1]} follow the group through the afternoon.",
+                'beats': numbers[::max(1, len(numbers) // 3)][:3]
+            })
+        max_beats = MAX_BEATS.search(prompt)
+        if max_beats:
+            step = max(1, -(-len(numbers) // int(max_beats.group(1))))
+            numbers = numbers[::step][:int(max_beats.group(1))]
+        return '\n\n'.join(
+            f"[IMAGE {number}]\nThe story moves on as the light changes, and everyone remembers this moment."
+            for number in numbers
+        )
@@ -0,0 +1,260 @@
+"""End-to-end benchmarks that need no network or API quota.
+
+Each scenario runs in its own Python process against the real Flask app,
+with Gemini replaced by ``bench.fake_gemini`` and Redis by in-memory
+storage, and drives ``/upload``, ``/jobs/<id>`` and ``/story/<id>``
+through the test client from several threads. Usage:
+
+    python -m bench.run                              # all scenarios
+    python -m bench.run single_upload story_views    # some of them
+    python -m bench.run --scale 0.25                 # smaller archives, for a quick check
+    python -m bench.run --save-baseline bench/baseline.json
+    python -m bench.run --baseline bench/baseline.json --tolerance 0.2
+
+With --baseline the exit status is 1 when any latency, peak RSS or byte
+count grew, or throughput fell, by more than the tolerance. Baselines are
+only comparable on the machine that recorded them. The fake model's
+latency and failure rates come from FAKE_GEMINI_* (see bench.fake_gemini);
+other app settings can be overridden through the environment as usual.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import itertools
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_MARKER = 'BENCH_RESULT '
+
+# name -> archive parameters and load; image counts (one per upload, or a list) are multiplied by --scale
+SCENARIOS = {
+    'single_upload': {'clients': 1, 'uploads': 1, 'images': 24, 'resolution': (1600, 1200), 'duplicate_ratio': 0.1},
+    'concurrent_uploads': {'clients': 4, 'uploads': 8, 'images': 16, 'resolution': (1600, 1200), 'duplicate_ratio': 0.2},
+    # One large story alongside small ones; job_p50_ms shows whether the small ones stay fast
+    'mixed_uploads': {'clients': 4, 'uploads': 4, 'images': [120, 8, 8, 8], 'resolution': (1024, 768), 'duplicate_ratio': 0.0},
+    'large_upload': {'clients': 1, 'uploads': 1, 'images': 150, 'resolution': (1024, 768), 'duplicate_ratio': 0.1},
+    'story_views': {'clients': 8, 'uploads': 1, 'images': 12, 'resolution': (1024, 768), 'duplicate_ratio': 0.0, 'views': 400}
+}
+
+# Result keys compared against a baseline; True when a larger value is better
+COMPARED = {
+    'throughput_images_per_s': True,
+    'throughput_views_per_s': True,
+    'upload_request_p50_ms': False,
+    'upload_request_p99_ms': False,
+    'job_p50_ms': False,
+    'job_p99_ms': False,
+    'story_view_p50_ms': False,
+    'story_view_p99_ms': False,
+    'peak_rss_mb': False,
+    'bytes_written': False
+}
+# Latency changes smaller than this are timer noise, whatever their relative size
+NOISE_FLOOR_MS = 1.0
+
+def percentile(values, fraction):
+    """Nearest-rank percentile; None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def latency_summary(prefix, seconds):
+    return {
+        f'{prefix}_p50_ms': round(percentile(seconds, 0.50) * 1000, 1) if seconds else None,
+        f'{prefix}_p99_ms': round(percentile(seconds, 0.99) * 1000, 1) if seconds else None
+    }
+
+def configure_environment(workdir):
+    """Point every external dependency and on-disk store of the app at local stand-ins"""
+    os.environ['GEMINI_BACKEND'] = 'bench.fake_gemini:FakeGenerativeModel'
+    os.environ['REDIS_URL'] = 'memory://'
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    os.environ['ANALYSIS_CACHE_PATH'] = os.path.join(workdir, 'analysis_cache.sqlite3')
+    os.environ['STORY_INDEX_PATH'] = os.path.join(workdir, 'story_index.sqlite3')
+    os.environ['UPLOAD_SESSION_FOLDER'] = os.path.join(workdir, 'uploads')
+    for name, value in (('GEMINI_API_KEY', 'bench'),
+                        ('GEMINI_RATE_LIMIT', '1000'),
+                        ('GEMINI_RATE_BURST', '1000'),
+                        ('FAKE_GEMINI_LATENCY', '0.05'),
+                        ('LOG_FILE', ''),
+                        ('LOG_LEVEL', 'WARNING'),
+                        ('STORY_SWEEP_INTERVAL', '3600')):
+        os.environ.setdefault(name, value)
+
+def upload_and_wait(client, zip_path, poll_interval=0.02, timeout=600):
+    """POST one archive and poll its job; returns (story_id, request seconds, job seconds)"""
+    start_time = time.perf_counter()
+    with open(zip_path, 'rb') as f:
+        response = client.post('/upload', data={'files[]': (f, os.path.basename(zip_path))},
+                               content_type='multipart/form-data')
+    request_seconds = time.perf_counter() - start_time
+    if response.status_code != 202:
+        raise RuntimeError(f"Upload failed with {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    story_id = response.get_json()['story_id']
+    while time.perf_counter() - start_time < timeout:
+        status = client.get(f'/jobs/{story_id}').get_json()
+        if status['status'] == 'done':
+            return story_id, request_seconds, time.perf_counter() - start_time
+        if status['status'] == 'error':
+            raise RuntimeError(f"Story job {story_id} failed: {status.get('error')}")
+        time.sleep(poll_interval)
+    raise RuntimeError(f"Story job {story_id} did not finish within {timeout}s")
+
+def view_story(client, story_id):
+    start_time = time.perf_counter()
+    response = client.get(f'/story/{story_id}')
+    if response.status_code != 200:
+        raise RuntimeError(f"Story view failed with {response.status_code}")
+    return time.perf_counter() - start_time
+
+def run_scenario(name, scale, workdir):
+    """Run one scenario in this process and return its result dict"""
+    configure_environment(workdir)
+    sys.path.insert(0, ROOT)
+    from bench.synthetic import make_zip
+    from app import create_app
+    from app.metrics import BYTES_WRITTEN
+
+    spec = SCENARIOS[name]
+    counts = spec['images'] if isinstance(spec['images'], list) else [spec['images']] * spec['uploads']
+    counts = [max(2, int(count * scale)) for count in counts]
+    zip_paths = []
+    for upload, count in enumerate(counts):
+        path = os.path.join(workdir, f'{name}_{upload}.zip')
+        # Distinct seeds so uploads do not share analysis cache entries
+        make_zip(path, count, spec['resolution'], spec['duplicate_ratio'], seed=upload)
+        zip_paths.append(path)
+
+    app = create_app()
+    local = threading.local()
+    addresses = itertools.count()
+    def client():
+        # Each load thread is its own client for rate limits and admission control
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            local.client.environ_base['REMOTE_ADDR'] = f'10.0.0.{next(addresses) % 250 + 1}'
+        return local.client
+
+    story_ids = []
+    result = {'scenario': name, 'images_per_upload': counts, 'uploads': spec['uploads'], 'clients': spec['clients']}
+    try:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=spec['clients']) as executor:
+            uploads = list(executor.map(lambda path: upload_and_wait(client(), path), zip_paths))
+        elapsed = time.perf_counter() - start_time
+        story_ids = [story_id for story_id, _, _ in uploads]
+        result['throughput_images_per_s'] = round(sum(counts) / elapsed, 2)
+        result.update(latency_summary('upload_request', [request_seconds for _, request_seconds, _ in uploads]))
+        result.update(latency_summary('job', [job_seconds for _, _, job_seconds in uploads]))
+
+        views = spec.get('views', len(story_ids))
+        targets = [story_ids[index % len(story_ids)] for index in range(views)]
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=spec['clients']) as executor:
+            view_seconds = list(executor.map(lambda story_id: view_story(client(), story_id), targets))
+        result['throughput_views_per_s'] = round(views / (time.perf_counter() - start_time), 2)
+        result.update(latency_summary('story_view', view_seconds))
+    finally:
+        for story_id in story_ids:
+            shutil.rmtree(os.path.join(app.static_folder, 'stories', story_id), ignore_errors=True)
+
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    with BYTES_WRITTEN.lock:
+        written = {kind: value for (kind,), value in BYTES_WRITTEN.values.items()}
+    result['bytes_written'] = sum(written.values())
+    result['bytes_written_by_kind'] = written
+    return result
+
+def run_isolated(name, scale):
+    """Run a scenario in a fresh interpreter so peak RSS and metrics are its own"""
+    workdir = tempfile.mkdtemp(prefix=f'photoyarn-bench-{name}-')
+    try:
+        completed = subprocess.run(
+            [sys.executable, '-m', 'bench.run', '--worker', name, '--workdir', workdir, '--scale', str(scale)],
+            cwd=ROOT, stdout=subprocess.PIPE, text=True
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    raise RuntimeError(f"Scenario {name} exited with status {completed.returncode} and no result")
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions beyond tolerance, as printable strings"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        for key, higher_is_better in COMPARED.items():
+            old, new = previous.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            if key.endswith('_ms') and abs(new - old) < NOISE_FLOOR_MS:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name}.{key}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+def print_table(results):
+    columns = ['throughput_images_per_s', 'job_p50_ms', 'job_p99_ms', 'story_view_p50_ms',
+               'story_view_p99_ms', 'peak_rss_mb', 'bytes_written']
+    print(f"{'scenario':<20}" + ''.join(f"{column:>26}" for column in columns))
+    for name, result in results.items():
+        print(f"{name:<20}" + ''.join(f"{str(result.get(column)):>26}" for column in columns))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.run', description='Run offline PhotoYarn benchmarks')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for images per upload')
+    parser.add_argument('--save-baseline', metavar='PATH', help='Write results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare results with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression (default 0.2)')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+
+    if args.worker:
+        print(RESULT_MARKER + json.dumps(run_scenario(args.worker, args.scale, args.workdir)), flush=True)
+        return 0
+
+    results = {}
+    for name in args.scenarios or list(SCENARIOS):
+        print(f"Running {name}...", file=sys.stderr, flush=True)
+        results[name] = run_isolated(name, args.scale)
+    print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'scale': args.scale, 'recorded_at': time.time(), 'scenarios': results}, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != args.scale:
+            print(f"Warning: baseline was recorded at scale {baseline.get('scale')}", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
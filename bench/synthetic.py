@@ -0,0 +1,41 @@
+"""Synthetic photo archives for benchmarks"""
+import io
+import zipfile
+import numpy as np
+from PIL import Image, ImageEnhance
+
+def make_image(rng, width, height):
+    """A smooth random colour field; distinct seeds give distinct perceptual hashes"""
+    coarse = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+    img = Image.fromarray(coarse, 'RGB').resize((width, height), Image.BICUBIC)
+    # Fine noise keeps JPEG sizes closer to real photos
+    noise = rng.integers(-12, 13, size=(height, width, 3), dtype=np.int16)
+    return Image.fromarray(np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255).astype(np.uint8), 'RGB')
+
+def make_zip(path, count, resolution=(1600, 1200), duplicate_ratio=0.0, seed=0, quality=85):
+    """Write a zip of ``count`` JPEGs to path and return its size in bytes.
+
+    Roughly ``duplicate_ratio`` of the images are near-duplicates of an
+    earlier one: the same scene slightly brightened and re-encoded, like a
+    burst of shots. A text file and a macOS resource fork are included so the
+    archive filters get exercised too.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    originals = []
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for index in range(count):
+            if originals and rng.random() < duplicate_ratio:
+                source = originals[rng.integers(len(originals))]
+                img = ImageEnhance.Brightness(source).enhance(1 + rng.uniform(0.01, 0.05))
+            else:
+                img = make_image(rng, width, height)
+                originals.append(img)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=quality)
+            zf.writestr(f"photos/IMG_{index:04d}.jpg", buffer.getvalue())
+        zf.writestr('photos/notes.txt', 'Not an image')
+        zf.writestr('__MACOSX/photos/._IMG_0000.jpg', b'\x00' * 64)
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        return f.tell()